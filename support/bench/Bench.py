@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BIN = os.path.join(HERE, '..', 'bin')
+sys.path.insert(0, BIN)
+
+import Util as my_utils  # noqa: E402
+
+from CamServer import CameraServer, snapshots  # noqa: E402
+from Synthetic import (CAM, NAME, build_index, make_archive,  # noqa: E402
+                       record_all_stats, write_config)
+
+# Frame size and interval of the synthetic archive, normal and --quick
+SIZE = (1280, 720)
+INTERVAL = 300
+QUICK_SIZE = (640, 360)
+QUICK_INTERVAL = 900
+REPEAT = 3
+# Captures per capture benchmark run
+CAPTURES = 20
+# Median slowdown, or peak RSS growth, that counts as a regression
+THRESHOLD = 0.2
+# Camera stand-ins: latency, jitter, failures and auth per benchmark
+SERVERS = {
+    'capture': {'latency': 0.02, 'auth': 'basic'},
+    'capture_digest': {'latency': 0.02, 'auth': 'digest'},
+    'capture_flaky': {'latency': 0.02, 'jitter': 0.05, 'fail_rate': 0.3,
+                      'auth': 'basic'},
+    'capture_frozen': {'latency': 0.02, 'auth': 'basic', 'frozen': True},
+}
+# Fast retries so a flaky camera costs round trips rather than sleeps
+RETRY = {'backoff': 0.05, 'max_backoff': 0.2, 'deadline': 30,
+         'breaker_threshold': 1000}
+
+logger = logging.getLogger("Bench Log")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('benchmarks', nargs='*',
+                    help='Benchmarks to run (default: all of them)')
+parser.add_argument('-o', '--output', type=str, required=False,
+                    help='Results file (default: bench-<time>.json)')
+parser.add_argument('-b', '--baseline', type=str, required=False,
+                    help='Earlier results file to compare against')
+parser.add_argument('-t', '--threshold', type=float, default=THRESHOLD,
+                    help=f'Fractional slowdown or memory growth reported as '
+                         f'a regression (default: {THRESHOLD})')
+parser.add_argument('-r', '--repeat', type=int, default=REPEAT,
+                    help=f'Runs per benchmark (default: {REPEAT})')
+parser.add_argument('-q', '--quick', action='store_true',
+                    help=f'Small archive: {QUICK_SIZE[0]}x{QUICK_SIZE[1]} '
+                         f'frames every {QUICK_INTERVAL}s')
+parser.add_argument('--size', type=int, nargs=2, required=False,
+                    metavar=('WIDTH', 'HEIGHT'),
+                    help=f'Frame size (default: {SIZE[0]} {SIZE[1]})')
+parser.add_argument('-i', '--interval', type=int, required=False,
+                    help=f'Seconds between archived frames '
+                         f'(default: {INTERVAL})')
+parser.add_argument('--stats', action='store_true',
+                    help='Give the archive statistics sidecars')
+parser.add_argument('--index', action='store_true',
+                    help='Give the archive an index')
+parser.add_argument('-w', '--workdir', type=str, required=False,
+                    help='Build the archive here and keep it (default: a '
+                         'temporary directory, removed afterwards)')
+parser.add_argument('--child', type=str, help=argparse.SUPPRESS)
+
+
+# Peak memory. Linux can reset a process's high-water mark, so a benchmark
+# reports the peak of the measured call rather than of imports and setup.
+
+def reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def memory_mb(field):
+    # VmRSS or VmHWM of this process, in MB
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(fn, *args, **kwargs):
+    # Time one call, with its peak RSS
+    baseline = memory_mb('VmRSS')
+    reset_peak()
+    started = time.perf_counter()
+    value = fn(*args, **kwargs)
+    seconds = time.perf_counter() - started
+    return value, {'seconds': seconds, 'peak_rss_mb': memory_mb('VmHWM'),
+                   'base_rss_mb': baseline}
+
+
+# Benchmarks. Each runs in its own process with CAMSDIR pointing at the
+# synthetic archive, and returns its measurements.
+
+def bench_capture(ctx):
+    import CamAcq
+    from Change import ChangeDetector
+    from Retry import CircuitBreaker, RetryPolicy
+    config = ctx['config']
+    session = CamAcq.make_session(config)
+    policy = RetryPolicy.from_config(config, CamAcq.logger)
+    breaker = CircuitBreaker.from_config(config)
+    change = ChangeDetector.from_config(config)
+
+    def run():
+        latencies = []
+        ok = 0
+        for _ in range(CAPTURES):
+            started = time.perf_counter()
+            ok += CamAcq.capture(config, session, datetime.now(), policy,
+                                 breaker, change)
+            latencies.append(time.perf_counter() - started)
+        return ok, latencies
+    (ok, latencies), out = measure(run)
+    out['captures'] = CAPTURES
+    out['ok'] = ok
+    out['total_seconds'] = out['seconds']
+    out['seconds'] = statistics.mean(latencies)
+    out['p95_seconds'] = sorted(latencies)[int(0.95 * (CAPTURES - 1))]
+    return out
+
+
+def bench_badpixels(ctx):
+    import numpy as np
+    from Composite import compute_luma, reject_bad_pixels
+    from Synthetic import Scene
+    scene = Scene(ctx['size'], 0)
+    luma = compute_luma(scene.bad_frame(ctx['end'].replace(hour=1)))
+    runs = 5
+
+    def run():
+        for _ in range(runs):
+            reject_bad_pixels(np.array(luma))
+    _, out = measure(run)
+    out['seconds'] /= runs
+    return out
+
+
+def bench_composite(ctx):
+    import DailyComposite
+    # webcopy also writes js.js, which write_composite always removes
+    error, out = measure(DailyComposite.create_composite, ctx['cam'],
+                         ctx['name'], ctx['size'], True,
+                         ctx['end'].strftime('%Y%m%d'))
+    if error:
+        raise RuntimeError(error)
+    return out
+
+
+def bench_movie(ctx):
+    import DailyMovie
+    from Pack import list_tree
+    DailyMovie.config = ctx['config']
+    day = ctx['end'] - timedelta(1)
+    camdir = f"{os.environ['CAMSDIR']}/{ctx['cam']}"
+    files = list_tree(f"{camdir}/images/archive/{day.strftime('%Y/%m/%d')}")
+    movie_name = f"{ctx['cam']}{day.strftime('%Y%m%d')}{ctx['name']}.avi"
+    _, out = measure(DailyMovie.create_and_copy_video, files, movie_name,
+                     f'{camdir}/movies', False, ctx['size'])
+    out['frames'] = len(files)
+    return out
+
+
+def bench_gif(ctx):
+    import MakeGif
+    MakeGif.config = ctx['config']
+    now = ctx['end'].replace(hour=23, minute=59)
+
+    def run():
+        frames = MakeGif.select_frames(ctx['cam'], now)
+        MakeGif.create_gif(frames)
+        return frames
+    frames, out = measure(run)
+    out['frames'] = len(frames)
+    return out
+
+
+def bench_prune(ctx):
+    import PruneData
+    results, out = measure(PruneData.prune_data, ctx['cam'])
+    return out
+
+
+def bench_prune_full(ctx):
+    import PruneData
+    configs = {ctx['cam']: ctx['config']}
+    results, out = measure(PruneData.prune, configs, full=True)
+    out['removed'] = sum(len(files) for files in results.values())
+    return out
+
+
+BENCHMARKS = {
+    'capture': bench_capture,
+    'capture_digest': bench_capture,
+    'capture_flaky': bench_capture,
+    'capture_frozen': bench_capture,
+    'badpixels': bench_badpixels,
+    'composite': bench_composite,
+    'movie': bench_movie,
+    'gif': bench_gif,
+    'prune': bench_prune,
+    'prune_full': bench_prune_full,
+}
+# Benchmarks that remove files get their own copy of the archive
+DESTRUCTIVE = ('prune', 'prune_full')
+
+
+def run_child(name, ctxfile):
+    with open(ctxfile) as f:
+        ctx = json.load(f)
+    ctx['end'] = datetime.strptime(ctx['end'], '%Y%m%d')
+    ctx['size'] = tuple(ctx['size'])
+    out = BENCHMARKS[name](ctx)
+    print(json.dumps(out))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=HERE,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build(workdir, size, interval, end, stats, index):
+    # The synthetic archive, and a camera config for the tools
+    camsdir = f'{workdir}/cams'
+    started = time.time()
+    counts = make_archive(camsdir, CAM, NAME, end, 2, size, interval)
+    if stats:
+        record_all_stats(camsdir, CAM)
+    if index:
+        build_index(camsdir, CAM)
+    logger.info(f'Built archive in {time.time() - started:.1f}s: '
+                + ', '.join(f'{n} {kind}' for kind, n in counts.items()))
+    return camsdir, counts
+
+
+def run_one(name, workdir, camsdir, ctx):
+    # One run of a benchmark in a fresh interpreter; its logs go to
+    # workdir/name.log
+    env = dict(os.environ)
+    env['CAMSDIR'] = camsdir
+    env.pop('CAMMETRICS', None)
+    env.pop('CAMPROFILE', None)
+    server = None
+    copy = None
+    try:
+        if name in SERVERS:
+            spec = dict(SERVERS[name])
+            count = 1 if spec.pop('frozen', False) else 8
+            server = CameraServer(snapshots(ctx['size'], count),
+                                  **spec).start()
+            ctx = dict(ctx, config=dict(ctx['config'], retry=RETRY,
+                                        **server.config()))
+        if name in DESTRUCTIVE:
+            # Hard links: removing a file leaves the original in place
+            copy = f'{workdir}/prune'
+            shutil.copytree(camsdir, copy, copy_function=os.link)
+            env['CAMSDIR'] = copy
+        ctxfile = f'{workdir}/{name}.ctx.json'
+        with open(ctxfile, 'w') as f:
+            json.dump(ctx, f)
+        with open(f'{workdir}/{name}.log', 'a') as log:
+            p = subprocess.run([sys.executable, os.path.abspath(__file__),
+                                '--child', name, ctxfile],
+                               env=env, stdout=subprocess.PIPE, stderr=log,
+                               cwd=workdir)
+        if p.returncode:
+            raise RuntimeError(f'{name} failed, see {workdir}/{name}.log')
+        out = json.loads(p.stdout.decode().strip().splitlines()[-1])
+        if server:
+            out['server'] = server.counts()
+        return out
+    finally:
+        if server:
+            server.stop()
+        if copy:
+            shutil.rmtree(copy)
+
+
+def summarize(runs):
+    # Median, min and max seconds and the largest peak RSS over runs, plus
+    # the other measurements of the median run
+    runs = sorted(runs, key=lambda r: r['seconds'])
+    out = dict(runs[len(runs) // 2])
+    out['runs'] = [r['seconds'] for r in runs]
+    out['min_seconds'] = runs[0]['seconds']
+    out['max_seconds'] = runs[-1]['seconds']
+    out['seconds'] = statistics.median(r['seconds'] for r in runs)
+    out['peak_rss_mb'] = max(r['peak_rss_mb'] for r in runs)
+    return out
+
+
+def compare(results, baseline, threshold):
+    # Log each benchmark against the baseline; returns the regressions
+    if baseline['params'] != results['params']:
+        logger.warning(f"Baseline was run with {baseline['params']}")
+    regressions = []
+    for name, new in sorted(results['results'].items()):
+        old = baseline['results'].get(name)
+        if not old:
+            logger.info(f'{name}: not in baseline')
+            continue
+        time_ratio = new['seconds'] / old['seconds']
+        rss_ratio = new['peak_rss_mb'] / old['peak_rss_mb']
+        flag = ''
+        if time_ratio > 1 + threshold or rss_ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        logger.info(f"{name}: {old['seconds']:.4f}s -> "
+                    f"{new['seconds']:.4f}s ({time_ratio:.2f}x), "
+                    f"peak RSS {old['peak_rss_mb']:.0f} -> "
+                    f"{new['peak_rss_mb']:.0f} MB ({rss_ratio:.2f}x){flag}")
+    return regressions
+
+
+def run(args):
+    names = args.benchmarks or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+    size = tuple(args.size or (QUICK_SIZE if args.quick else SIZE))
+    interval = args.interval or (QUICK_INTERVAL if args.quick else INTERVAL)
+    end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    params = {'size': list(size), 'interval': interval, 'stats': args.stats,
+              'index': args.index}
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='cambench')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        camsdir, counts = build(workdir, size, interval, end, args.stats,
+                                args.index)
+        write_config(f'{workdir}/etc', CAM, NAME, size)
+        ctx = {'cam': CAM, 'name': NAME, 'size': list(size),
+               'end': end.strftime('%Y%m%d'),
+               'config': {'cam': CAM, 'name': NAME, 'size': list(size)}}
+        results = {}
+        for name in names:
+            runs = [run_one(name, workdir, camsdir, ctx)
+                    for _ in range(args.repeat)]
+            results[name] = summarize(runs)
+            logger.info(f"{name}: {results[name]['seconds']:.4f}s "
+                        f"(min {results[name]['min_seconds']:.4f}s), "
+                        f"peak RSS {results[name]['peak_rss_mb']:.0f} MB")
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    out = {'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+           'host': platform.node(), 'python': platform.python_version(),
+           'revision': git_revision(), 'params': params,
+           'repeat': args.repeat, 'archive': counts,
+           'results': results}
+    path = args.output \
+        or f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(path, 'w') as f:
+        json.dump(out, f, indent=2, sort_keys=True)
+    logger.info(f'Wrote {path}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        return compare(out, baseline, args.threshold)
+    return []
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.child:
+        run_child(args.child, args.benchmarks[0])
+        sys.exit(0)
+
+    logger = my_utils.setup_logging("Bench Log")
+    if 'PYLOGLEVEL' in os.environ:
+        level = logging.getLevelName(os.getenv('PYLOGLEVEL', 'DEBUG'))
+        logger.setLevel(level)
+
+    logger.info('Starting')
+    regressions = run(args)
+    if regressions:
+        logger.info(f"Regressions: {', '.join(regressions)}")
+    logger.info('Finished')
+    logging.shutdown()
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import base64
+import hashlib
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN)
+
+import Util as my_utils  # noqa: E402
+
+REALM = 'camera'
+SNAPSHOT = '/snapshot.jpg'
+# How a failed request fails: an error status, a body cut short, or no
+# answer until the client gives up
+FAIL_MODES = ('status', 'truncate', 'hang')
+HANG = 120
+
+logger = logging.getLogger("CamServer Log")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-p', '--port', type=int, default=8080,
+                    help='Port to listen on (default: 8080)')
+parser.add_argument('-l', '--latency', type=float, default=0,
+                    help='Seconds before each response (default: 0)')
+parser.add_argument('--jitter', type=float, default=0,
+                    help='Up to this many seconds more, at random '
+                         '(default: 0)')
+parser.add_argument('-f', '--fail-rate', type=float, default=0,
+                    help='Fraction of requests that fail (default: 0)')
+parser.add_argument('--fail-mode', choices=FAIL_MODES, default='status',
+                    help='How requests fail (default: status)')
+parser.add_argument('-a', '--auth', choices=['none', 'basic', 'digest'],
+                    default='none', help='Authentication (default: none)')
+parser.add_argument('--user', type=str, default='admin')
+parser.add_argument('--passwd', type=str, default='admin')
+parser.add_argument('--size', type=int, nargs=2, default=(1280, 720),
+                    metavar=('WIDTH', 'HEIGHT'),
+                    help='Snapshot size (default: 1280 720)')
+parser.add_argument('--frozen', action='store_true',
+                    help='Serve the same snapshot every time')
+
+
+def md5(s):
+    return hashlib.md5(s.encode()).hexdigest()
+
+
+def parse_digest(header):
+    # Fields of a Digest Authorization header
+    return {k: v1 or v2 for k, v1, v2 in
+            re.findall(r'(\w+)=(?:"([^"]*)"|([^,\s]*))', header)}
+
+
+class CameraServer(ThreadingHTTPServer):
+    # Stand-in for an IP camera: GET /snapshot.jpg returns the next of
+    # `frames` (JPEG bytes), after `latency` plus up to `jitter` seconds,
+    # failing `fail_rate` of the time, behind optional basic or digest auth
+
+    daemon_threads = True
+
+    def __init__(self, frames, port=0, latency=0, jitter=0, fail_rate=0,
+                 fail_mode='status', auth=None, user='admin',
+                 passwd='admin', seed=0):
+        super().__init__(('127.0.0.1', port), SnapshotHandler)
+        self.frames = frames
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.fail_mode = fail_mode
+        self.auth = None if auth == 'none' else auth
+        self.user = user
+        self.passwd = passwd
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.nonces = set()
+        self.served = 0
+        self.requests = 0
+        self.challenges = 0
+        self.failures = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}{SNAPSHOT}'
+
+    def config(self):
+        # The parts of a camera config that point CamAcq here
+        config = {'url': self.url}
+        if self.auth:
+            config['auth'] = {'type': self.auth, 'user': self.user,
+                              'passwd': self.passwd}
+        return config
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def counts(self):
+        with self.lock:
+            return {'requests': self.requests, 'served': self.served,
+                    'challenges': self.challenges,
+                    'failures': self.failures}
+
+    def draw(self):
+        # Delay, whether to fail, and the frame for one request
+        with self.lock:
+            self.requests += 1
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            fail = self.rng.random() < self.fail_rate
+            frame = self.frames[self.served % len(self.frames)]
+            if fail:
+                self.failures += 1
+            else:
+                self.served += 1
+        return delay, fail, frame
+
+    def new_nonce(self):
+        nonce = os.urandom(16).hex()
+        with self.lock:
+            self.challenges += 1
+            self.nonces.add(nonce)
+        return nonce
+
+    def authorized(self, header, method, uri):
+        if not self.auth:
+            return True
+        if self.auth == 'basic':
+            token = base64.b64encode(f'{self.user}:{self.passwd}'.encode())
+            return header == f'Basic {token.decode()}'
+        if not header.startswith('Digest '):
+            return False
+        d = parse_digest(header[7:])
+        if d.get('nonce') not in self.nonces \
+                or d.get('username') != self.user or d.get('uri') != uri:
+            return False
+        ha1 = md5(f'{self.user}:{REALM}:{self.passwd}')
+        ha2 = md5(f'{method}:{uri}')
+        if d.get('qop'):
+            expected = md5(f"{ha1}:{d['nonce']}:{d.get('nc')}:"
+                           f"{d.get('cnonce')}:{d['qop']}:{ha2}")
+        else:
+            expected = md5(f"{ha1}:{d['nonce']}:{ha2}")
+        return d.get('response') == expected
+
+
+class SnapshotHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        logger.debug(fmt % args)
+
+    def do_GET(self):
+        server = self.server
+        if self.path != SNAPSHOT:
+            self.reply(404, b'Not found')
+            return
+        if not server.authorized(self.headers.get('Authorization', ''),
+                                 'GET', self.path):
+            self.challenge()
+            return
+        delay, fail, frame = server.draw()
+        if delay:
+            time.sleep(delay)
+        if fail and server.fail_mode == 'status':
+            self.reply(503, b'Camera busy')
+        elif fail and server.fail_mode == 'hang':
+            time.sleep(HANG)
+            self.close_connection = True
+        elif fail:
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(frame)))
+            self.end_headers()
+            self.wfile.write(frame[:len(frame) // 2])
+            self.close_connection = True
+        else:
+            self.reply(200, frame, 'image/jpeg')
+
+    def challenge(self):
+        self.send_response(401)
+        if self.server.auth == 'basic':
+            value = f'Basic realm="{REALM}"'
+        else:
+            value = (f'Digest realm="{REALM}", qop="auth", algorithm=MD5, '
+                     f'nonce="{self.server.new_nonce()}"')
+        self.send_header('WWW-Authenticate', value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def reply(self, status, body, ctype='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def snapshots(size, count=8, seed=0):
+    # Encoded frames of the synthetic scene, a few minutes apart
+    from Synthetic import Scene, encode
+    scene = Scene(size, seed)
+    now = datetime.now().replace(microsecond=0)
+    return [encode(scene.frame(now.replace(minute=(now.minute + 5 * i) % 60)))
+            for i in range(count)]
+
+
+if __name__ == '__main__':
+    logger = my_utils.setup_logging("CamServer Log")
+    if 'PYLOGLEVEL' in os.environ:
+        level = logging.getLevelName(os.getenv('PYLOGLEVEL', 'DEBUG'))
+        logger.setLevel(level)
+
+    args = parser.parse_args()
+    logger.info('Starting')
+    frames = snapshots(tuple(args.size), 1 if args.frozen else 8)
+    server = CameraServer(frames, args.port, args.latency, args.jitter,
+                          args.fail_rate, args.fail_mode, args.auth,
+                          args.user, args.passwd)
+    logger.info(f'Serving {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info(f'Stopping: {server.counts()}')
+    server.server_close()
+    logger.info('Finished')
+    logging.shutdown()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import cv2
+import json
+import logging
+import math
+import numpy as np
+import os
+import sys
+
+from datetime import datetime, timedelta
+
+BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN)
+
+import Util as my_utils  # noqa: E402
+
+# Archive layout written by CamAcq, below a CAMSDIR
+ARCHPATH = '{0}/{1}/images/archive/{2:%Y/%m/%d/%H}'
+CAM = 'BNcam'
+NAME = 'BN'
+SIZE = (1280, 720)
+# Seconds between frames
+INTERVAL = 300
+QUALITY = 90
+# One in this many frames is damaged, per kind of damage
+CORRUPT_EVERY = 37
+EMPTY_EVERY = 41
+BAD_EVERY = 11
+# Old movies, composites and GIFs for the retention sweep
+OLD_MOVIES = 20
+OLD_COMPOSITES = 40
+
+logger = logging.getLogger("Synthetic Log")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-o', '--outdir', type=str, required=True,
+                    help='CAMSDIR to fill')
+parser.add_argument('-c', '--cam', type=str, default=CAM,
+                    help=f'Camera code (default: {CAM})')
+parser.add_argument('-n', '--name', type=str, default=NAME,
+                    help=f'Frame name (default: {NAME})')
+parser.add_argument('-d', '--date', type=str, required=False,
+                    help='Last day to fill, yyyymmdd (default: today)')
+parser.add_argument('--days', type=int, default=2,
+                    help='Days to fill, ending on --date (default: 2)')
+parser.add_argument('--size', type=int, nargs=2, default=SIZE,
+                    metavar=('WIDTH', 'HEIGHT'),
+                    help=f'Frame size (default: {SIZE[0]} {SIZE[1]})')
+parser.add_argument('-i', '--interval', type=int, default=INTERVAL,
+                    help=f'Seconds between frames (default: {INTERVAL})')
+parser.add_argument('-s', '--seed', type=int, default=0,
+                    help='Random seed (default: 0)')
+parser.add_argument('--stats', action='store_true',
+                    help='Also write the per-hour statistics sidecars')
+parser.add_argument('--index', action='store_true',
+                    help='Also build the archive index')
+
+
+class Scene(object):
+    # A fixed synthetic view: terrain, a vent glowing at night and a star
+    # field, drawn at any time of day with fresh sensor noise
+
+    def __init__(self, size, seed=0):
+        self.width, self.height = size
+        self.rng = np.random.RandomState(seed)
+        w, h = size
+        y = np.linspace(0, 1, h, dtype=np.float32)[:, None]
+        x = np.linspace(0, 1, w, dtype=np.float32)[None, :]
+        # Ridge line across the lower half, sky above it
+        ridge = 0.55 + 0.08 * np.sin(6 * x + 1) + 0.03 * np.sin(23 * x)
+        self.ground = (y > ridge).astype(np.float32)
+        self.sky = 1 - self.ground
+        self.gradient = (1 - y) * self.sky + 0.4 * self.ground
+        # Vent glow, a wide ellipse on the ridge
+        cx, cy = 0.6, 0.62
+        self.glow = np.exp(-((x - cx) ** 2 / 0.004 + (y - cy) ** 2 / 0.0015))
+        n = w * h // 4000
+        self.stars = (self.rng.randint(0, h, n), self.rng.randint(0, w, n),
+                      self.rng.uniform(60, 255, n).astype(np.float32))
+
+    def daylight(self, tm):
+        # 0 at night, 1 at noon, with dawn at 6 and dusk at 18
+        hours = tm.hour + tm.minute / 60
+        return max(0.0, math.sin(math.pi * (hours - 6) / 12))
+
+    def frame(self, tm):
+        light = self.daylight(tm)
+        h, w = self.height, self.width
+        luma = 10 + 200 * light * self.gradient
+        if light < 0.2:
+            ys, xs, v = self.stars
+            luma[ys, xs] = np.maximum(luma[ys, xs], v * self.sky[ys, xs]
+                                      * (1 - 5 * light))
+        # The glow flickers over minutes and is washed out by day
+        flicker = 0.75 + 0.25 * math.sin(tm.timestamp() / 517)
+        glow = 230 * flicker * self.glow * (1 - light)
+        img = np.empty((h, w, 3), dtype=np.float32)
+        img[..., 0] = luma * (1 - 0.2 * light) + 0.1 * glow
+        img[..., 1] = luma + 0.45 * glow
+        img[..., 2] = luma * (1 - 0.1 * light) + glow
+        img += self.rng.normal(0, 3 + 4 * (1 - light), (h, w, 1))
+        img = np.clip(img, 0, 255).astype(np.uint8)
+        cv2.putText(img, tm.strftime('%Y-%m-%d %H:%M:%S'), (10, h - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, h / 1000, (255, 255, 255), 1)
+        return img
+
+    def bad_frame(self, tm):
+        # A frame with the 127-129 "bad pixel" signature: a block of
+        # mid-gray pixels large enough to trip neighborhood rejection
+        img = self.frame(tm)
+        h, w = img.shape[:2]
+        bh, bw = h // 6, w // 6
+        y = self.rng.randint(0, h - bh)
+        x = self.rng.randint(0, w - bw)
+        img[y:y + bh, x:x + bw] = 128
+        return img
+
+
+def encode(img, quality=QUALITY):
+    ok, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buf.tobytes()
+
+
+def frame_times(end, days, interval):
+    # Capture times for every slot of the days ending on end
+    start = datetime(end.year, end.month, end.day) - timedelta(days - 1)
+    t = start
+    stop = start + timedelta(days)
+    while t < stop:
+        yield t
+        t += timedelta(seconds=interval)
+
+
+def make_archive(camsdir, cam=CAM, name=NAME, end=None, days=2, size=SIZE,
+                 interval=INTERVAL, seed=0):
+    # Fill camsdir/cam with a CamAcq-style archive. Every CORRUPT_EVERY'th
+    # frame is truncated, every EMPTY_EVERY'th is zero bytes and every
+    # BAD_EVERY'th night frame carries the bad pixel signature. Returns
+    # counts by kind.
+    end = end or datetime.now()
+    scene = Scene(size, seed)
+    counts = {'ok': 0, 'corrupt': 0, 'empty': 0, 'bad': 0}
+    for i, tm in enumerate(frame_times(end, days, interval)):
+        path = ARCHPATH.format(camsdir, cam, tm)
+        os.makedirs(path, exist_ok=True)
+        archived = f"{path}/{tm.strftime('%Y%m%d%H%M%S')}{name}.jpg"
+        if i % EMPTY_EVERY == EMPTY_EVERY - 1:
+            data = b''
+            counts['empty'] += 1
+        elif i % CORRUPT_EVERY == CORRUPT_EVERY - 1:
+            data = encode(scene.frame(tm))
+            data = data[:len(data) // 2]
+            counts['corrupt'] += 1
+        elif i % BAD_EVERY == BAD_EVERY - 1 and not scene.daylight(tm):
+            data = encode(scene.bad_frame(tm))
+            counts['bad'] += 1
+        else:
+            data = encode(scene.frame(tm))
+            counts['ok'] += 1
+        with open(archived, 'wb') as f:
+            f.write(data)
+        os.utime(archived, (tm.timestamp(), tm.timestamp()))
+    make_artifacts(camsdir, cam, name, end)
+    return counts
+
+
+def make_artifacts(camsdir, cam, name, end):
+    # Web images, and movies and composites spanning the retention limits
+    camdir = f'{camsdir}/{cam}'
+    os.makedirs(f'{camdir}/images', exist_ok=True)
+    os.makedirs(f'{camdir}/movies', exist_ok=True)
+    for n in range(OLD_MOVIES):
+        tm = end - timedelta(days=n)
+        movie = f"{camdir}/movies/{cam}{tm.strftime('%Y%m%d')}{name}.avi"
+        with open(movie, 'wb') as f:
+            f.write(b'\0' * 4096)
+        os.utime(movie, (tm.timestamp(), tm.timestamp()))
+    for n in range(OLD_COMPOSITES):
+        tm = end - timedelta(days=n)
+        path = f"{camdir}/composites/archive/{tm.strftime('%Y/%m')}"
+        os.makedirs(path, exist_ok=True)
+        comp = f"{path}/{cam}{tm.strftime('%Y%m%d')}{name}.jpg"
+        # A few composites of nights without frames were left empty
+        with open(comp, 'wb') as f:
+            f.write(b'' if n % 7 == 3 else b'\xff\xd8\xff\xd9')
+        os.utime(comp, (tm.timestamp(), tm.timestamp()))
+
+
+def record_all_stats(camsdir, cam):
+    # Statistics sidecars as frame_stats acquisition would have left them
+    from Stats import record_stats
+    root = f'{camsdir}/{cam}/images/archive'
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if fname.endswith('.jpg'):
+                path = os.path.join(dirpath, fname)
+                with open(path, 'rb') as f:
+                    record_stats(path, f.read())
+
+
+def build_index(camsdir, cam):
+    from ArchiveIndex import ArchiveIndex
+    index = ArchiveIndex(cam, f'{camsdir}/{cam}/images/archive')
+    index.rebuild()
+    index.close()
+
+
+def write_config(confdir, cam=CAM, name=NAME, size=SIZE, **extra):
+    # Camera config for the tools, as in /app/camacquisition/etc
+    config = {'cam': cam, 'name': name, 'size': list(size)}
+    config.update(extra)
+    os.makedirs(confdir, exist_ok=True)
+    path = f'{confdir}/{cam}.json'
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=2)
+    return path
+
+
+if __name__ == '__main__':
+    logger = my_utils.setup_logging("Synthetic Log")
+    if 'PYLOGLEVEL' in os.environ:
+        level = logging.getLevelName(os.getenv('PYLOGLEVEL', 'DEBUG'))
+        logger.setLevel(level)
+
+    args = parser.parse_args()
+    logger.info('Starting')
+    end = datetime.strptime(args.date, '%Y%m%d') if args.date \
+        else datetime.now()
+    counts = make_archive(args.outdir, args.cam, args.name, end, args.days,
+                          tuple(args.size), args.interval, args.seed)
+    logger.info(', '.join(f'{n} {kind}' for kind, n in counts.items()))
+    if args.stats:
+        record_all_stats(args.outdir, args.cam)
+    if args.index:
+        build_index(args.outdir, args.cam)
+    logger.info('Finished')
+    logging.shutdown()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import sqlite3
+import Util as my_utils
+
+from datetime import datetime
+from Frames import probe_frame
+from Pack import PACK_SUFFIX, getsize, list_hour
+
+ARCHIVE = os.getenv('CAMSDIR', '/data/cams')
+ROOT = '{}/{}/images/archive'
+DB = 'index.sqlite'
+TSFMT = '%Y-%m-%d %H:%M:%S'
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS frames (
+    path TEXT PRIMARY KEY,
+    ts TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    valid INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS frames_ts ON frames (ts);
+'''
+
+logger = logging.getLogger("ArchiveIndex Log")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--cam', type=str, required=True, help='Camera code')
+group = parser.add_mutually_exclusive_group(required=True)
+group.add_argument('--rebuild', action='store_true',
+                   help='Recreate the index from the files on disk')
+group.add_argument('--verify', action='store_true',
+                   help='Compare the index with the files on disk')
+
+
+def frame_time(relpath):
+    # Capture time from a YYYY/MM/DD/HH/YYYYmmddHHMMSS<name>.jpg path
+    parts = relpath.split('/')
+    try:
+        return datetime.strptime(parts[-1][:14], '%Y%m%d%H%M%S')
+    except ValueError:
+        return datetime.strptime('/'.join(parts[:4]), '%Y/%m/%d/%H')
+
+
+def walk_archive(root):
+    # Relative paths of every frame under an archive root, via scandir
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        with os.scandir(f'{root}/{rel}' if rel else root) as it:
+            for entry in it:
+                name = f'{rel}/{entry.name}' if rel else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(name)
+                elif entry.name.endswith('.jpg') \
+                        and not entry.name.startswith('.') and rel:
+                    yield name
+                elif entry.name.endswith(PACK_SUFFIX) \
+                        and not entry.name.startswith('.') and rel:
+                    # A packed hour's frames keep their loose paths
+                    hour = name[:-len(PACK_SUFFIX)]
+                    # Loose frames of a partly repacked hour come from its
+                    # directory
+                    loose = os.path.isdir(f'{root}/{hour}')
+                    for n in list_hour(f'{root}/{hour}'):
+                        if not loose \
+                                or not os.path.exists(f'{root}/{hour}/{n}'):
+                            yield f'{hour}/{n}'
+
+
+class ArchiveIndex(object):
+    # Per-camera SQLite catalog of archived frames: path (relative to the
+    # archive root), capture time, size, dimensions and validity. Tools use
+    # it for time-range queries instead of walking the directory tree.
+    # Only used once created with --rebuild, so cameras opt in.
+
+    def __init__(self, cam, root=None):
+        self.cam = cam
+        self.root = root or ROOT.format(ARCHIVE, cam)
+        self.path = f'{self.root}/{DB}'
+        self.db = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def connect(self):
+        if self.db is None:
+            # A generous timeout rides out the other writer's transactions
+            self.db = sqlite3.connect(self.path, timeout=60)
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.root)
+
+    def row(self, path, size=None, width=None, height=None, valid=None):
+        rel = self.relpath(path)
+        if size is None:
+            size, width, height, valid = probe_frame(path)
+        return (rel, frame_time(rel).strftime(TSFMT), size, width, height,
+                int(bool(valid)))
+
+    def add(self, path, size=None, width=None, height=None, valid=None):
+        # Record a frame; without details the file's head and tail are read
+        db = self.connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO frames VALUES (?,?,?,?,?,?)',
+                       self.row(path, size, width, height, valid))
+
+    def remove(self, paths):
+        db = self.connect()
+        with db:
+            db.executemany('DELETE FROM frames WHERE path = ?',
+                           [(self.relpath(p),) for p in paths])
+
+    def query(self, sql, args):
+        return self.connect().execute(sql, args).fetchall()
+
+    def frames(self, start, end, suffix='', valid_only=False):
+        # Absolute paths of frames with start <= time < end, in time order
+        sql = 'SELECT path FROM frames WHERE ts >= ? AND ts < ?'
+        args = [start.strftime(TSFMT), end.strftime(TSFMT)]
+        if suffix:
+            sql += ' AND path LIKE ?'
+            args.append(f'%{suffix}')
+        if valid_only:
+            sql += ' AND valid = 1'
+        sql += ' ORDER BY ts, path'
+        return [f'{self.root}/{r[0]}' for r in self.query(sql, args)]
+
+    def first_per_hour(self, start, end):
+        # Earliest frame (by name) of each hour with start <= time < end
+        sql = 'SELECT MIN(path) FROM frames WHERE ts >= ? AND ts < ? ' \
+            'GROUP BY substr(ts, 1, 13) ORDER BY substr(ts, 1, 13)'
+        rows = self.query(sql, [start.strftime(TSFMT), end.strftime(TSFMT)])
+        return [f'{self.root}/{r[0]}' for r in rows]
+
+    def empty(self, start, end):
+        sql = 'SELECT path FROM frames WHERE ts >= ? AND ts < ? AND size = 0'
+        rows = self.query(sql, [start.strftime(TSFMT), end.strftime(TSFMT)])
+        return [f'{self.root}/{r[0]}' for r in rows]
+
+    def rebuild(self):
+        tmp = f'{self.path}.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        db = sqlite3.connect(tmp)
+        db.executescript(SCHEMA)
+        count = 0
+        batch = []
+        for rel in walk_archive(self.root):
+            batch.append(self.row(f'{self.root}/{rel}'))
+            if len(batch) >= 1000:
+                db.executemany('INSERT INTO frames VALUES (?,?,?,?,?,?)',
+                               batch)
+                count += len(batch)
+                batch = []
+                logger.debug(f'Indexed {count} frames')
+        db.executemany('INSERT INTO frames VALUES (?,?,?,?,?,?)', batch)
+        count += len(batch)
+        db.commit()
+        db.close()
+        self.close()
+        os.replace(tmp, self.path)
+        return count
+
+    def verify(self):
+        # Frames missing from the index, index rows with no file, and rows
+        # whose recorded size no longer matches the file
+        indexed = dict(self.query('SELECT path, size FROM frames', []))
+        missing = []
+        changed = []
+        for rel in walk_archive(self.root):
+            size = indexed.pop(rel, None)
+            if size is None:
+                missing.append(rel)
+            elif size != getsize(f'{self.root}/{rel}'):
+                changed.append(rel)
+        return missing, sorted(indexed), changed
+
+
+def open_index(cam):
+    # The camera's index if it has one, else None
+    index = ArchiveIndex(cam)
+    return index if index.exists() else None
+
+
+if __name__ == '__main__':
+    logger = my_utils.setup_logging("ArchiveIndex Log")
+    if 'PYLOGLEVEL' in os.environ:
+        level = logging.getLevelName(os.getenv('PYLOGLEVEL', 'DEBUG'))
+        logger.setLevel(level)
+
+    args = parser.parse_args()
+    logger.info('Starting')
+    index = ArchiveIndex(args.cam)
+    if args.rebuild:
+        logger.info(f'Rebuilding {index.path}')
+        logger.info(f'Indexed {index.rebuild()} frames')
+    elif not index.exists():
+        logger.info(f'No index at {index.path}')
+    else:
+        missing, stale, changed = index.verify()
+        for label, rels in (('Not indexed', missing),
+                            ('No longer on disk', stale),
+                            ('Size changed', changed)):
+            logger.info(f'{label}: {len(rels)}')
+            for rel in rels[:20]:
+                logger.info(f'  {rel}')
+    index.close()
+    logger.info('Finished')
+    logging.shutdown()
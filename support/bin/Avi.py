@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import struct
+
+# AVI 1.0 uses 32-bit RIFF sizes; stay well clear of what players accept
+AVI_LIMIT = 2 ** 31 - 1
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+
+class AviTooLarge(ValueError):
+    pass
+
+
+class MjpegAviWriter(object):
+    # Writes JPEG bitstreams unchanged as the frames of an MJPG AVI, the
+    # same container cv2.VideoWriter produces for the MJPG fourcc
+
+    def __init__(self, path, size, fps=10):
+        self.path = path
+        self.width, self.height = size
+        self.fps = fps
+        self.index = []
+        self.max_frame = 0
+        self.f = open(path, 'wb')
+        self._write_headers()
+
+    def _chunk(self, fourcc, data):
+        self.f.write(struct.pack('<4sI', fourcc, len(data)))
+        self.f.write(data)
+        if len(data) % 2:
+            self.f.write(b'\0')
+
+    def _write_headers(self):
+        w, h = self.width, self.height
+        f = self.f
+        f.write(struct.pack('<4sI4s', b'RIFF', 0, b'AVI '))
+        f.write(struct.pack('<4sI4s', b'LIST', 4 + 64 + 12 + 64 + 48,
+                            b'hdrl'))
+        self._avih = f.tell() + 8
+        self._chunk(b'avih', struct.pack(
+            '<14I', 1000000 // self.fps, 0, 0, AVIF_HASINDEX, 0, 0, 1, 0,
+            w, h, 0, 0, 0, 0))
+        f.write(struct.pack('<4sI4s', b'LIST', 4 + 64 + 48, b'strl'))
+        self._strh = f.tell() + 8
+        self._chunk(b'strh', struct.pack(
+            '<4s4sIHHIIIIIIIIhhhh', b'vids', b'MJPG', 0, 0, 0, 0, 1,
+            self.fps, 0, 0, 0, 0xFFFFFFFF, 0, 0, 0, w, h))
+        self._chunk(b'strf', struct.pack(
+            '<IiiHH4sIiiII', 40, w, h, 1, 24, b'MJPG', w * h * 3, 0, 0, 0,
+            0))
+        self._movi = f.tell()
+        f.write(struct.pack('<4sI4s', b'LIST', 0, b'movi'))
+
+    def write(self, jpeg):
+        size = len(jpeg)
+        pos = self.f.tell()
+        # Frame chunk, its index entry, and the idx1 header must still fit
+        end = pos + 8 + size + size % 2 + 16 * (len(self.index) + 1) + 8
+        if end > AVI_LIMIT:
+            raise AviTooLarge(f'{self.path} would exceed {AVI_LIMIT} bytes')
+        self._chunk(b'00dc', jpeg)
+        # idx1 offsets are relative to the 'movi' fourcc
+        self.index.append((pos - (self._movi + 8), size))
+        self.max_frame = max(self.max_frame, size)
+
+    def close(self):
+        f = self.f
+        if f.closed:
+            return
+        movi_end = f.tell()
+        f.write(struct.pack('<4sI', b'idx1', 16 * len(self.index)))
+        for offset, size in self.index:
+            f.write(struct.pack('<4sIII', b'00dc', AVIIF_KEYFRAME, offset,
+                                size))
+        end = f.tell()
+        frames = len(self.index)
+
+        # Patch sizes and counts now that they are known
+        f.seek(4)
+        f.write(struct.pack('<I', end - 8))
+        f.seek(self._avih + 4)
+        f.write(struct.pack('<I', self.max_frame * self.fps))
+        f.seek(self._avih + 16)
+        f.write(struct.pack('<I', frames))
+        f.seek(self._avih + 28)
+        f.write(struct.pack('<I', self.max_frame))
+        f.seek(self._strh + 32)
+        f.write(struct.pack('<II', frames, self.max_frame))
+        f.seek(self._movi + 4)
+        f.write(struct.pack('<I', movi_end - (self._movi + 8)))
+        f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -2,33 +2,71 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import io
 import json
 import logging
 import os
-import requests
-import shutil
 import sys
+import threading
 import time
+import Metrics as my_metrics
 import Util as my_utils
 
-from datetime import datetime, timedelta
-from PIL import Image
+from ArchiveIndex import open_index
+from Change import ChangeDetector
+from collections import namedtuple
+from datetime import datetime
+from glob import glob
+from Retry import CircuitBreaker, RetryPolicy
+
+# requests, PIL/numpy (image pipeline), asyncio and the process pools are
+# imported where they are used. A per-minute cron capture pays for them
+# only once it needs them, and the image pipeline loads on a thread while
+# the fetch waits on the camera. ImportTime.py checks the budget.
 
 NOW = datetime.now()
-TMP = '/tmp/img{0}.jpg'
-TMB = '/tmp/img{0}.thumb.jpg'
-JS = '/tmp/js{0}.js'
-ARCHPATH = '/data/cams/{0}/images/archive/{1}/{2}/{3}/{4}'
-IMG = '/data/cams/{0}/images/{1}'
-WATERMARK = '/app/camacquisition/bin/usgs_watermark_wht.png'
+CAMSDIR = os.getenv('CAMSDIR', '/data/cams')
+ARCHPATH = CAMSDIR + '/{0}/images/archive/{1}/{2}/{3}/{4}'
+IMG = CAMSDIR + '/{0}/images/{1}'
+WATERMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'usgs_watermark_wht.png')
 TFMT = '%Y-%m-%d %H:%M:%S'
+CONFDIR = '/app/camacquisition/etc'
+BREAKER = '/tmp/breaker{0}.json'
+CHANGE = '/tmp/change{0}.json'
+PARTIAL_IMG = CAMSDIR + '/{0}/composites/partial.jpg'
+
+# What process() made of a frame
+Captured = namedtuple('Captured', 'archived size time full thumb')
 
 logger = my_utils.setup_logging("CamAcq Log")
 
 # Argparse
 parser = argparse.ArgumentParser()
-parser.add_argument('-c', '--config', type=str, required=True,
+parser.add_argument('-c', '--config', type=str, required=False,
                     help='Config file')
+parser.add_argument('--daemon', action='store_true',
+                    help='Capture every camera in --confdir from one '
+                         'long-running process')
+parser.add_argument('-d', '--confdir', type=str, required=False,
+                    default=CONFDIR,
+                    help=f'Camera config directory (default: {CONFDIR})')
+parser.add_argument('--engine', choices=['threads', 'async'],
+                    default='threads',
+                    help='Daemon engine: a thread per capture, or one event '
+                         'loop fetching every camera at the tick '
+                         '(default: threads)')
+parser.add_argument('--concurrency', type=int, default=16,
+                    help='Async engine: max fetches in flight (default: 16)')
+parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                    help='Async engine: processes for watermarking and '
+                         'thumbnails (default: CPU count)')
+parser.add_argument('--live', type=int, metavar='PORT', required=False,
+                    help='Daemon: serve each camera\'s latest frame over '
+                         'HTTP on this port')
+
+# LiveView store, filled by the daemons when --live is given
+_live = None
 
 
 def read_config(configfile):
@@ -37,109 +75,529 @@ def read_config(configfile):
         return json.load(f)
 
 
-def get(url, timeout, auth=None):
-    with requests.session() as s:
-        s.keep_alive = False
-        try:
-            if auth:
-                mauth = None
-                if auth['type'] == 'digest':
-                    mauth = requests.auth.HTTPDigestAuth(auth['user'],
-                                                         auth['passwd'])
-                else:
-                    mauth = requests.auth.HTTPBasicAuth(auth['user'],
-                                                        auth['passwd'])
-                return requests.get(url, auth=mauth, timeout=timeout)
-            else:
-                return requests.get(url, timeout=timeout)
-        except Exception:
-            if datetime.now() > NOW + timedelta(seconds=55):
-                logger.info('Giving up.')
-                sys.exit()
-            else:
-                time.sleep(5)
-                return get(url, auth, timeout)
-        finally:
-            s.close()
+def make_auth(auth):
+    import requests
+    if auth['type'] == 'digest':
+        return requests.auth.HTTPDigestAuth(auth['user'], auth['passwd'])
+    return requests.auth.HTTPBasicAuth(auth['user'], auth['passwd'])
 
 
-if __name__ == '__main__':
-    if 'PYLOGLEVEL' in os.environ:
-        level = logging.getLevelName(os.getenv('PYLOGLEVEL', 'DEBUG'))
-        logger.setLevel(level)
+def make_session(config):
+    # Keep-alive session for a long-lived camera. Auth lives on the session,
+    # so a digest nonce is negotiated once and reused for later captures.
+    import requests
+    s = requests.Session()
+    s.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=1))
+    s.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=1))
+    if 'auth' in config:
+        s.auth = make_auth(config['auth'])
+    return s
 
-    args = parser.parse_args()
-    logger.info('Starting')
-    config = read_config(args.config)
 
+def fetch(url, timeout, auth=None, session=None):
+    # One attempt; error statuses count as failures
+    import requests
+    if session:
+        r = session.get(url, timeout=timeout)
+    else:
+        with requests.session() as s:
+            s.keep_alive = False
+            mauth = make_auth(auth) if auth else None
+            r = s.get(url, auth=mauth, timeout=timeout)
+    r.raise_for_status()
+    return r
+
+
+def get(url, timeout, auth=None, session=None, start=None, policy=None,
+        name=None):
+    start = start or NOW
+    policy = policy or RetryPolicy(logger=logger)
+    with my_metrics.timer('fetch', cam=name or url):
+        return policy.call(lambda t: fetch(url, t, auth, session), start,
+                           timeout, name or url)
+
+
+def update_partial_composite(config, frame, tm):
+    # Fold a night frame into the running composite for its night. Imported
+    # here so cameras without incremental compositing skip numpy/cv2.
+    from Composite import (PARTIAL, IncrementalComposite, night_date,
+                           partial_lock)
+    ndate = night_date(tm)
+    if ndate is None:
+        return
+    cam = config['cam']
+    prefix = PARTIAL.format(cam, ndate.strftime('%Y%m%d'), config['name'])
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    width, height = config['size']
+    with partial_lock(prefix):
+        composite = IncrementalComposite(prefix, height, width)
+        composite.fold(frame)
+        logger.debug(f'Partial composite now has {composite.frames} frames')
+        if config.get('publish_partial_composite'):
+            from cv2 import imwrite
+            tmpfile = f'{prefix}.tmp.jpg'
+            imwrite(tmpfile, composite.image)
+            os.replace(tmpfile, PARTIAL_IMG.format(cam))
+
+
+def import_pipeline():
+    # The image pipeline's modules: PIL, numpy and the watermark
+    from PIL import Image  # noqa: F401
+    import Derivatives  # noqa: F401
+    import Watermark  # noqa: F401
+
+
+def preload():
+    # Import the image pipeline on a thread, overlapping it with the fetch
+    if 'Watermark' not in sys.modules:
+        threading.Thread(target=import_pipeline, daemon=True).start()
+
+
+def camera_timeout(config):
     timeout = 20
     if 'timeout' in config:
         timeout = config['timeout']
+    return timeout
 
-    if 'auth' in config:
-        r = get(config['url'], config['auth'], timeout)
-    else:
-        r = get(config['url'], timeout)
+
+def capture(config, session=None, start=None, policy=None, breaker=None,
+            change=None):
+    start = start or NOW
+    cam = config['cam']
+    policy = policy or RetryPolicy.from_config(config, logger)
+    breaker = breaker or CircuitBreaker.from_config(config,
+                                                    BREAKER.format(cam))
+    change = change or ChangeDetector.from_config(config, CHANGE.format(cam))
+    if not breaker.allow():
+        logger.info(f'{cam}: camera marked dead, skipping until '
+                    f'{breaker.retry_at().strftime(TFMT)}')
+        my_metrics.count('captures', cam=cam, result='breaker_open')
+        return False
+    preload()
+    r = get(config['url'], camera_timeout(config), config.get('auth'),
+            session, start, policy, cam)
+    breaker.record(r is not None)
+    if r is None:
+        my_metrics.count('captures', cam=cam, result='failed')
+        return False
+    my_metrics.count('captures', cam=cam, result='ok')
     logger.debug('Got image')
+    if check_change(config, change, r.content, start):
+        captured = process(config, r.content, start)
+        change.kept(captured.archived, captured.size)
+        publish_live(cam, captured)
+    return True
+
+
+def publish_live(cam, captured):
+    if _live is not None:
+        _live.publish(cam, captured.full, captured.thumb, captured.time)
+
+
+def check_change(config, change, content, start):
+    # Whether a fetched frame should be processed. Repeats of the last kept
+    # frame are skipped or linked to it, per the camera's "change" action,
+    # and a run of them flags the camera as frozen.
+    cam = config['cam']
+    was_frozen, repeats = change.frozen, change.repeats
+    kind = change.check(content)
+    my_metrics.gauge('frozen', int(change.frozen), cam=cam)
+    if kind == 'new':
+        if was_frozen:
+            logger.warning(f'{cam}: camera recovered after {repeats} '
+                           f'repeated frames')
+        return True
+    my_metrics.count('repeated_frames', cam=cam, kind=kind)
+    same = 'identical' if kind == 'duplicate' else 'nearly identical'
+    logger.info(f'{cam}: frame {same} to the last one kept, '
+                f'{change.repeats} in a row')
+    if change.frozen and not was_frozen:
+        logger.warning(f'{cam}: camera appears frozen, no new frame since '
+                       f'{change.frozen_since().strftime(TFMT)}')
+    if change.action == 'keep':
+        return True
+    if change.action == 'link':
+        link_previous(config, change, start)
+    return False
+
+
+def archive_dir(cam, start):
+    return ARCHPATH.format(cam, start.year, str(start.month).zfill(2),
+                           str(start.day).zfill(2), str(start.hour).zfill(2))
+
+
+def link_previous(config, change, start):
+    # Archive a repeated frame as a hard link to the last kept one, so the
+    # archive has an entry for the slot without another copy of the frame
+    if not change.archived:
+        return
+    cam = config['cam']
+    path = archive_dir(cam, start)
+    os.makedirs(path, exist_ok=True)
+    tm = datetime.now()
+    archived = f"{path}/{tm.strftime('%Y%m%d%H%M%S')}{config['name']}.jpg"
+    try:
+        my_utils.link_atomic(change.archived, archived)
+    except FileNotFoundError:
+        # Pruned or packed since
+        logger.info(f'{cam}: {change.archived} is gone, not linking')
+        return
+    logger.debug(f'Linked {archived} to {change.archived}')
+    update_index(cam, archived, os.path.getsize(archived), change.size)
+
+
+def update_stats(archived, frame):
+    # Per-frame luma statistics for the hour's sidecar, from the frame
+    # process() decoded. Imported here so cameras without them skip
+    # numpy/cv2.
+    from Stats import record_frame
+    stats = record_frame(archived, frame)
+    logger.debug(f"Frame luma mean {stats['mean']:.1f}, "
+                 f"max {stats['max']:.1f}, {stats['band']} band pixels")
+
+
+def update_index(cam, archived, nbytes, size):
+    # Record the frame in the camera's archive index, if it has one
+    try:
+        index = open_index(cam)
+        if index:
+            index.add(archived, nbytes, size[0], size[1], True)
+            index.close()
+    except Exception as e:
+        logger.error(f'Unable to update archive index: {e}')
+
+
+def process(config, content, start):
+    from Derivatives import (derivative_path, derivative_specs, encode_jpeg,
+                             make_derivatives)
+    from PIL import Image
+    from Watermark import apply_watermark
 
     # Set up variables based on config
     cam = config['cam']
     iname = config['name']
-    tmpfile = TMP.format(cam)
-    tmpthumb = TMB.format(cam)
-    tmpjs = JS.format(cam)
-    path = ARCHPATH.format(cam, NOW.year, str(NOW.month).zfill(2),
-                           str(NOW.day).zfill(2), str(NOW.hour).zfill(2))
-
-    with open(tmpfile, 'wb') as f:
-        f.write(r.content)
-
-    # Crop KI and M1 cams
-    if cam in ['KIcam', 'M1cam']:
-        logger.debug(f'Cropping {cam} image.')
-        with Image.open(tmpfile) as im:
+    path = archive_dir(cam, start)
+
+    # Decode once; the full image is encoded from this decode
+    crop = 0
+    with Image.open(io.BytesIO(content)) as im:
+        with my_metrics.timer('decode', cam=cam):
+            im.load()
+
+        # Crop KI and M1 cams
+        if cam in ['KIcam', 'M1cam']:
+            logger.debug(f'Cropping {cam} image.')
+            crop = config['crop']
             w, h = im.size
-            im = im.crop((0, 0, w, h-config['crop']))
-            im.save(tmpfile)
-
-    # Add watermark, create thumbnail
-    with Image.open(tmpfile) as im:
-        w, h = im.size
-        with Image.open(WATERMARK) as wm:
-            logger.debug('Adding watermark')
-            w2, h2 = wm.size
-            im.paste(wm, (10, h - (h2 + 10)), wm)
-            im.save(tmpfile)
-
-        logger.debug('Creating thumbnail')
-        im.thumbnail((w * 0.3, h * 0.3))
-        im.save(tmpthumb, 'JPEG')
-
-    # Copy to archive
+            im = im.crop((0, 0, w, h-crop))
+
+        # Add watermark
+        size = im.size
+        logger.debug('Adding watermark')
+        with my_metrics.timer('watermark', cam=cam):
+            apply_watermark(im, WATERMARK, config.get('watermark'))
+        with my_metrics.timer('encode', cam=cam):
+            full = encode_jpeg(im)
+
+        # Keep the pixels for the frame statistics rather than decoding the
+        # encoded frame again
+        frame = None
+        if config.get('frame_stats'):
+            from Stats import image_frame
+            frame = image_frame(im)
+
+    # Thumbnail and other derivatives from one reduced-resolution decode
+    logger.debug('Creating thumbnail')
+
+    def stamp(d, factor):
+        options = dict(config.get('watermark') or {})
+        options['scale'] = options.get('scale', 1.0) * factor
+        options['margin'] = round(options.get('margin', 10) * factor)
+        apply_watermark(d, WATERMARK, options)
+
+    with my_metrics.timer('derivatives', cam=cam):
+        derivatives = make_derivatives(content, size,
+                                       derivative_specs(config), crop, stamp)
+        thumb = encode_jpeg(derivatives.pop('thumb'))
+
+    # Write to archive
     if not os.path.exists(path):
         logger.debug(f'Creating new archive dir: {path}')
         os.makedirs(path)
-    logger.debug('Copying to archive')
+    logger.debug('Writing to archive')
     tm = datetime.now()
-    shutil.copy2(tmpfile, f"{path}/{tm.strftime('%Y%m%d%H%M%S')}{iname}.jpg")
-
-    # Make js.js
-    logger.debug('Making js.js')
-    with open(tmpjs, 'w') as f:
-        f.write(f'var datetime = "{tm.strftime(TFMT)} (HST)";\n')
-        f.write(f'var frames   = new Array("{iname}");')
-
-    # Copy stuff to lamp
-    logger.info('Copying to lamp')
-    shutil.copy2(tmpfile, IMG.format(cam, f'{iname}.jpg'))
-    shutil.copy2(tmpthumb, IMG.format(cam, f'{iname}.thumb.jpg'))
-    shutil.copy2(tmpjs, IMG.format(cam, 'js.js'))
-
-    # Delete from tmp
-    logger.debug('Removing from tmp')
-    os.remove(tmpfile)
-    os.remove(tmpthumb)
-    os.remove(tmpjs)
+    archived = f"{path}/{tm.strftime('%Y%m%d%H%M%S')}{iname}.jpg"
+    with my_metrics.timer('archive', cam=cam):
+        my_utils.write_atomic(archived, full)
+    with my_metrics.timer('index', cam=cam):
+        update_index(cam, archived, len(full), size)
+    if config.get('frame_stats'):
+        try:
+            with my_metrics.timer('stats', cam=cam):
+                update_stats(archived, frame)
+        except Exception as e:
+            logger.error(f'Unable to record frame statistics: {e}')
+    with my_metrics.timer('archive', cam=cam):
+        for dname, d in derivatives.items():
+            dpath = derivative_path(archived, dname)
+            os.makedirs(os.path.dirname(dpath), exist_ok=True)
+            my_utils.write_atomic(dpath, encode_jpeg(d))
+
+    # Publish to lamp. The full image shares the archive copy's inode.
+    # Cameras viewed only through the live view can turn this off with
+    # "publish_files": false.
+    if config.get('publish_files', True):
+        logger.info('Copying to lamp')
+        with my_metrics.timer('publish', cam=cam):
+            my_utils.link_atomic(archived, IMG.format(cam, f'{iname}.jpg'))
+            my_utils.write_atomic(IMG.format(cam, f'{iname}.thumb.jpg'),
+                                  thumb)
+            logger.debug('Making js.js')
+            my_utils.write_atomic(IMG.format(cam, 'js.js'),
+                                  f'var datetime = "{tm.strftime(TFMT)} '
+                                  f'(HST)";\n'
+                                  f'var frames   = new Array("{iname}");'
+                                  .encode())
+    my_metrics.observe('frame_bytes', len(full), cam=cam)
+
+    # Fold night frames into the running composite
+    if config.get('incremental_composite'):
+        try:
+            with my_metrics.timer('composite', cam=cam):
+                update_partial_composite(config, archived, tm)
+        except Exception as e:
+            logger.error(f'Unable to update partial composite: {e}')
+    my_metrics.maybe_flush()
+    return Captured(archived, size, tm, full, thumb)
+
+
+class Camera(object):
+    # Long-lived state for one camera in daemon mode
+
+    def __init__(self, config):
+        self.config = config
+        self.cam = config['cam']
+        self.interval = config.get('interval', 60)
+        self.timeout = camera_timeout(config)
+        self.session = make_session(config)
+        self.policy = RetryPolicy.from_config(config, logger)
+        self.breaker = CircuitBreaker.from_config(config)
+        self.change = ChangeDetector.from_config(config)
+        self.busy = False
+
+    def renew_session(self, old):
+        # Give later requests a new session while a request abandoned on
+        # timeout still holds old on its thread; sessions aren't safe to
+        # share between threads
+        if self.session is old:
+            self.session = make_session(self.config)
+
+    def due(self, tick):
+        return int(tick.timestamp()) % self.interval == 0
+
+    def run(self, start):
+        self.busy = True
+        try:
+            if not capture(self.config, self.session, start, self.policy,
+                           self.breaker, self.change):
+                logger.info(f'{self.cam}: no image this interval')
+        except Exception as e:
+            logger.error(f'{self.cam}: capture failed: {e}')
+        finally:
+            self.busy = False
+
+    def close(self):
+        self.session.close()
+
+
+def load_cameras(confdir):
+    cameras = []
+    for configfile in sorted(glob(f'{confdir}/*.json')):
+        config = read_config(configfile)
+        if 'url' in config and 'cam' in config:
+            cameras.append(Camera(config))
+    return cameras
+
+
+def run_daemon(confdir):
+    from concurrent.futures import ThreadPoolExecutor
+    cameras = load_cameras(confdir)
+    if not cameras:
+        logger.error(f'No camera configs found in {confdir}')
+        return
+    logger.info(f'Running {len(cameras)} cameras: '
+                + ', '.join(c.cam for c in cameras))
+    with ThreadPoolExecutor(max_workers=len(cameras)) as pool:
+        try:
+            while True:
+                # Sleep to the next whole second, then start every camera
+                # whose interval lands on it
+                time.sleep(1 - (time.time() % 1))
+                tick = datetime.now().replace(microsecond=0)
+                my_metrics.maybe_flush()
+                for camera in cameras:
+                    if not camera.due(tick):
+                        continue
+                    if camera.busy:
+                        logger.info(f'{camera.cam}: previous capture still '
+                                    'running, skipping')
+                        continue
+                    camera.busy = True
+                    pool.submit(camera.run, tick)
+        except KeyboardInterrupt:
+            logger.info('Stopping')
+        finally:
+            for camera in cameras:
+                camera.close()
+
+
+async def fetch_async(camera, tick, limit, fetchers):
+    # Retry one camera within its policy. The semaphore bounds how many
+    # requests are in flight and is released while backing off.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if not camera.breaker.allow():
+        logger.info(f'{camera.cam}: camera marked dead, skipping until '
+                    f'{camera.breaker.retry_at().strftime(TFMT)}')
+        return None
+
+    def release(future, session):
+        # Close an abandoned request's session once its thread is done
+        if not future.cancelled():
+            future.exception()
+        session.close()
+
+    async def attempt(timeout):
+        async with limit:
+            session = camera.session
+            future = loop.run_in_executor(fetchers, fetch,
+                                          camera.config['url'], timeout,
+                                          None, session)
+            try:
+                # wait_for can't stop the thread, only stop waiting for it
+                return await asyncio.wait_for(asyncio.shield(future),
+                                              timeout=timeout)
+            except asyncio.TimeoutError:
+                camera.renew_session(session)
+                future.add_done_callback(lambda f: release(f, session))
+                raise
+
+    r = await camera.policy.call_async(attempt, tick, camera.timeout,
+                                       camera.cam)
+    camera.breaker.record(r is not None)
+    return r.content if r is not None else None
+
+
+async def acquire_tick(cameras, tick, limit, fetchers, workers):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    fetched = {}
+
+    async def acquire(camera):
+        camera.busy = True
+        try:
+            content = await fetch_async(camera, tick, limit, fetchers)
+            if content is None:
+                return
+            fetched[camera.cam] = time.time()
+            logger.debug(f'{camera.cam}: got image')
+            if not check_change(camera.config, camera.change, content, tick):
+                return
+            captured = await loop.run_in_executor(
+                workers, process, camera.config, content, tick)
+            camera.change.kept(captured.archived, captured.size)
+            publish_live(camera.cam, captured)
+        except Exception as e:
+            logger.error(f'{camera.cam}: capture failed: {e}')
+        finally:
+            camera.busy = False
+
+    await asyncio.gather(*(acquire(c) for c in cameras))
+    if len(fetched) > 1:
+        spread = max(fetched.values()) - min(fetched.values())
+        logger.info(f'Fetched {len(fetched)}/{len(cameras)} cameras, '
+                    f'spread {spread * 1000:.0f} ms')
+
+
+def init_worker():
+    # Spawned process() workers keep their own metrics
+    my_metrics.setup_metrics('camacq', f'worker{os.getpid()}')
+
+
+async def async_daemon(cameras, concurrency, nworkers):
+    import asyncio
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    limit = asyncio.Semaphore(concurrency)
+    # Spawned workers don't inherit the fetch threads or the event loop
+    ctx = multiprocessing.get_context('spawn')
+    with ThreadPoolExecutor(max_workers=concurrency) as fetchers, \
+            ProcessPoolExecutor(max_workers=nworkers, mp_context=ctx,
+                                initializer=init_worker) as workers:
+        ticks = set()
+        while True:
+            await asyncio.sleep(1 - (time.time() % 1))
+            tick = datetime.now().replace(microsecond=0)
+            my_metrics.maybe_flush()
+            due = []
+            for camera in cameras:
+                if not camera.due(tick):
+                    continue
+                if camera.busy:
+                    logger.info(f'{camera.cam}: previous capture still '
+                                'running, skipping')
+                    continue
+                camera.busy = True
+                due.append(camera)
+            if due:
+                task = asyncio.ensure_future(
+                    acquire_tick(due, tick, limit, fetchers, workers))
+                ticks.add(task)
+                task.add_done_callback(ticks.discard)
+
+
+def run_async_daemon(confdir, concurrency, nworkers):
+    import asyncio
+    cameras = load_cameras(confdir)
+    if not cameras:
+        logger.error(f'No camera configs found in {confdir}')
+        return
+    logger.info(f'Running {len(cameras)} cameras asynchronously: '
+                + ', '.join(c.cam for c in cameras))
+    try:
+        asyncio.run(async_daemon(cameras, concurrency, nworkers))
+    except KeyboardInterrupt:
+        logger.info('Stopping')
+    finally:
+        for camera in cameras:
+            camera.close()
+
+
+if __name__ == '__main__':
+    if 'PYLOGLEVEL' in os.environ:
+        level = logging.getLevelName(os.getenv('PYLOGLEVEL', 'DEBUG'))
+        logger.setLevel(level)
+
+    args = parser.parse_args()
+    logger.info('Starting')
+    if args.daemon:
+        my_metrics.setup_metrics('camacq')
+    if args.daemon and args.live:
+        from LiveView import serve
+        _live = serve(args.live)
+    elif args.live:
+        parser.error('--live needs --daemon')
+    if args.daemon and args.engine == 'async':
+        run_async_daemon(args.confdir, args.concurrency, args.workers)
+    elif args.daemon:
+        run_daemon(args.confdir)
+    elif args.config:
+        config = read_config(args.config)
+        my_metrics.setup_metrics('camacq', config.get('cam'))
+        if not capture(config):
+            sys.exit()
+    else:
+        parser.error('one of -c/--config or --daemon is required')
 
     logger.info('Finished')
     logging.shutdown()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import io
+import json
+import os
+import time
+
+from datetime import datetime
+
+# Defaults, overridable per camera with a "change" block in the config, e.g.
+#   {"change": {"action": "link", "near": 1.0, "frozen_after": 10}}
+#   action:       what happens to a repeat of the last kept frame: "skip"
+#                 it, "link" its archive entry to the last kept frame, or
+#                 "keep" it (only count and flag it)
+#   near:         also treat frames whose downsampled luma differs from the
+#                 last kept frame's by at most this many gray levels, on
+#                 average, as repeats (null: only byte-identical frames)
+#   frozen_after: repeats in a row before the camera is flagged frozen
+ACTION = 'skip'
+ACTIONS = ('skip', 'link', 'keep')
+NEAR = None
+FROZEN_AFTER = 5
+# Luma preview compared for near-identical frames, width x height
+PREVIEW = (32, 18)
+
+
+def luma_preview(content):
+    # Downsampled luma of a JPEG, from a reduced-resolution decode
+    from PIL import Image
+    with Image.open(io.BytesIO(content)) as im:
+        im.draft('L', (PREVIEW[0] * 2, PREVIEW[1] * 2))
+        return im.convert('L').resize(PREVIEW, Image.BOX).tobytes()
+
+
+def preview_difference(a, b):
+    # Mean absolute difference of two previews, in gray levels
+    return sum(abs(x - y) for x, y in zip(a, b)) / len(a)
+
+
+class ChangeDetector(object):
+    # Remembers the last frame a camera returned that was kept: its SHA-1,
+    # a luma preview when near-identical frames count as repeats, and where
+    # it was archived. Counts repeats in a row to spot a frozen encoder.
+    # With a state file the memory survives between cron runs. A new frame
+    # only replaces the last kept one once kept() reports it archived, so
+    # a frame that fails to process is not taken for a repeat next time.
+
+    def __init__(self, action=ACTION, near=NEAR, frozen_after=FROZEN_AFTER,
+                 state_file=None):
+        if action not in ACTIONS:
+            raise ValueError(f'Unknown change action: {action}')
+        self.action = action
+        self.near = near
+        self.frozen_after = frozen_after
+        self.state_file = state_file
+        self.sha1 = None
+        self.preview = None
+        self.archived = None
+        self.size = None
+        self.repeats = 0
+        self.since = 0
+        self.pending = None
+        if state_file and os.path.exists(state_file):
+            try:
+                with open(state_file) as f:
+                    state = json.load(f)
+                self.sha1 = state['sha1']
+                self.preview = state['preview'] \
+                    and bytes.fromhex(state['preview'])
+                self.archived = state['archived']
+                self.size = state['size']
+                self.repeats = state['repeats']
+                self.since = state['since']
+            except (ValueError, KeyError):
+                pass
+
+    @classmethod
+    def from_config(cls, config, state_file=None):
+        change = config.get('change', {})
+        return cls(action=change.get('action', ACTION),
+                   near=change.get('near', NEAR),
+                   frozen_after=change.get('frozen_after', FROZEN_AFTER),
+                   state_file=state_file)
+
+    @property
+    def frozen(self):
+        return self.repeats >= self.frozen_after
+
+    def frozen_since(self):
+        return datetime.fromtimestamp(self.since)
+
+    def check(self, content):
+        # 'new', 'duplicate' (same bytes) or 'near' (same picture) for a
+        # fetched frame, compared with the last kept frame
+        sha1 = hashlib.sha1(content).hexdigest()
+        kind = 'duplicate' if sha1 == self.sha1 else 'new'
+        preview = None
+        if kind == 'new' and self.near is not None:
+            try:
+                preview = luma_preview(content)
+            except OSError:
+                # Not a decodable JPEG; processing will report it
+                pass
+            if preview and self.preview and len(preview) == len(self.preview) \
+                    and preview_difference(preview, self.preview) <= self.near:
+                kind = 'near'
+        if kind == 'new':
+            self.pending = (sha1, preview)
+            self.repeats = 0
+            self.since = 0
+        else:
+            self.pending = None
+            if not self.repeats:
+                self.since = time.time()
+            self.repeats += 1
+        self.save()
+        return kind
+
+    def kept(self, archived, size):
+        # Where the last kept frame went, for linking repeats to it
+        if self.pending:
+            self.sha1, self.preview = self.pending
+            self.pending = None
+        self.archived = archived
+        self.size = list(size)
+        self.save()
+
+    def save(self):
+        if not self.state_file:
+            return
+        tmpfile = f'{self.state_file}.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump({'sha1': self.sha1,
+                       'preview': self.preview and self.preview.hex(),
+                       'archived': self.archived, 'size': self.size,
+                       'repeats': self.repeats, 'since': self.since}, f)
+        os.replace(tmpfile, self.state_file)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+import fcntl
+import Metrics as my_metrics
+import numpy as np
+import os
+
+from contextlib import contextmanager
+from datetime import timedelta
+from Frames import load_frame
+from numpy.lib.format import open_memmap
+
+# Partial composite files for a night: {prefix}.npy, .luma.npy and .txt,
+# next to the .lock file partial_lock holds
+PARTIAL = os.getenv('CAMSDIR', '/data/cams') \
+    + '/{0}/composites/partial/{0}{1}{2}'
+
+# Night window: EVENING_HOURS of the previous day and MORNING_HOURS of the
+# day the composite is dated
+EVENING_HOURS = range(20, 24)
+MORNING_HOURS = range(0, 5)
+
+# Luma weights, applied to the channels in the order frames are stored
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+
+# Bad pixel signature: luma strictly between BAD_LO and BAD_HI
+BAD_LO = 127
+BAD_HI = 129
+# Frames with more band pixels than this get neighborhood rejection
+BAD_FRAME = 5000
+# Band pixels with more than BAD_NEIGHBORS band pixels in their window
+# (about rows r-5..r+4, cols c-5..c+4; see reject_bad_pixels) are zeroed
+BAD_NEIGHBORS = 10
+BAD_BEFORE = 5
+BAD_AFTER = 5
+
+
+def night_date(tm):
+    # Date of the night composite a frame taken at tm belongs to, or None
+    if tm.hour in EVENING_HOURS:
+        return (tm + timedelta(days=1)).date()
+    if tm.hour in MORNING_HOURS:
+        return tm.date()
+    return None
+
+
+def compute_luma(frame, out=None):
+    if out is None:
+        out = np.empty(frame.shape[:2], dtype=np.float32)
+    w0, w1, w2 = (np.float32(w) for w in LUMA_WEIGHTS)
+    np.multiply(frame[:, :, 0], w0, out=out, dtype=np.float32)
+    out += frame[:, :, 1] * w1
+    out += frame[:, :, 2] * w2
+    return out
+
+
+def reject_bad_pixels(luma, band=None):
+    # Zero every band pixel whose neighborhood holds too many band pixels,
+    # flagging exactly the pixels the original per-pixel loop did. That
+    # loop scanned in row order and zeroed as it went, so a pixel's count
+    # leaves out band pixels already zeroed before it in the scan. Its
+    # window was rows rmin:rmax, cols cmin:cmax with
+    #   rmin = max(r - 5, 0)           cmin = max(c - 5, 0)
+    #   rmax = r + 5, or h - 1 when r + 5 >= h (one row short at the bottom)
+    #   rmax = w - 1 when c + 5 >= w (a cmax/rmax typo near the right edge)
+    # and both quirks are kept. Rows are handled one at a time against the
+    # rows already processed; within a row only pixels whose fate depends
+    # on a band pixel zeroed to their left are decided one by one.
+    if band is None:
+        band = np.logical_and(luma > BAD_LO, luma < BAD_HI)
+    h, w = band.shape
+    current = band.copy()
+    cols = np.arange(w)
+    lo = np.maximum(cols - BAD_BEFORE, 0)
+    hi = np.minimum(cols + BAD_AFTER, w)
+    # Band pixels per column over rows top:bottom, the current window
+    window = np.zeros(w, dtype=np.int32)
+    top = bottom = 0
+    sums = np.zeros(w + 1, dtype=np.int32)
+    gone = np.zeros(w, dtype=bool)
+    rejected = 0
+    for r in range(h):
+        rmin = max(r - BAD_BEFORE, 0)
+        rmax = r + BAD_AFTER if r + BAD_AFTER < h else h - 1
+        while bottom < rmax:
+            window += current[bottom]
+            bottom += 1
+        while top < rmin:
+            window -= current[top]
+            top += 1
+        idx = np.flatnonzero(current[r])
+        if not len(idx):
+            continue
+
+        # Band pixels in each one's window, before any of this row is
+        # zeroed, and whether the window holds this row
+        np.cumsum(window, out=sums[1:])
+        counts = sums[hi[idx]] - sums[lo[idx]]
+        own = np.full(len(idx), r < rmax)
+        for k in np.flatnonzero(idx + BAD_AFTER >= w):
+            counts[k] = np.count_nonzero(current[rmin:w - 1, lo[idx[k]]:])
+            own[k] = r < w - 1
+
+        # Zeroing can only lower a count, and only by the pixels zeroed
+        # to the left in the same window when the window holds this row
+        keep = counts > BAD_NEIGHBORS
+        idx, counts, own = idx[keep], counts[keep], own[keep]
+        if not len(idx):
+            continue
+        left = np.arange(len(idx)) - np.searchsorted(idx, lo[idx])
+        sure = counts - np.where(own, left, 0) > BAD_NEIGHBORS
+        gone[idx[sure]] = True
+        for k in np.flatnonzero(~sure):
+            c = idx[k]
+            if counts[k] - np.count_nonzero(gone[lo[c]:c]) > BAD_NEIGHBORS:
+                gone[c] = True
+        zeroed = idx[gone[idx]]
+        gone[zeroed] = False
+        current[r, zeroed] = False
+        luma[r, zeroed] = 0
+        if r < bottom:
+            window[zeroed] -= 1
+        rejected += len(zeroed)
+    return rejected
+
+
+class MaxLumaComposite(object):
+    # Keeps, for every pixel, the color of the brightest frame seen so far.
+    # The accumulator stays uint8 and its luma is cached as float32, so each
+    # frame costs one luma pass and two masked in-place copies.
+
+    def __init__(self, height, width):
+        self.image = np.zeros((height, width, 3), dtype=np.uint8)
+        self.luma = np.zeros((height, width), dtype=np.float32)
+        self.frames = 0
+        self._frame_luma = np.empty((height, width), dtype=np.float32)
+        self._band = np.empty((height, width), dtype=bool)
+        self._mask = np.empty((height, width), dtype=bool)
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    def add(self, frame):
+        if frame.shape != self.image.shape:
+            raise ValueError(f'Frame shape {frame.shape} does not match '
+                             f'composite shape {self.image.shape}')
+        with my_metrics.timer('luma'):
+            luma = compute_luma(frame, self._frame_luma)
+
+        # Detect and ignore bad pixels
+        band = self._band
+        np.greater(luma, BAD_LO, out=band)
+        np.logical_and(band, luma < BAD_HI, out=band)
+        if np.count_nonzero(band) > BAD_FRAME:
+            with my_metrics.timer('bad_pixels'):
+                rejected = reject_bad_pixels(luma, band)
+            my_metrics.count('bad_pixels_rejected', int(rejected))
+
+        # Take every pixel that is strictly brighter than the accumulator
+        np.greater(luma, self.luma, out=self._mask)
+        np.copyto(self.image, frame, where=self._mask[:, :, None])
+        np.copyto(self.luma, luma, where=self._mask)
+        self.frames += 1
+
+    def merge(self, other):
+        # Fold in a partial composite built from frames that come after
+        # this one's; strict comparison keeps ties with the earlier frame,
+        # exactly as feeding the frames one by one would
+        if other.shape != self.shape:
+            raise ValueError(f'Composite shape {other.shape} does not match '
+                             f'composite shape {self.shape}')
+        np.greater(other.luma, self.luma, out=self._mask)
+        np.copyto(self.image, other.image, where=self._mask[:, :, None])
+        np.copyto(self.luma, other.luma, where=self._mask)
+        self.frames += other.frames
+
+    def __getstate__(self):
+        # Only ship the accumulator between processes, not scratch buffers
+        return {'image': self.image, 'luma': self.luma,
+                'frames': self.frames}
+
+    def __setstate__(self, state):
+        height, width = state['luma'].shape
+        self.__init__(height, width)
+        self.image = state['image']
+        self.luma = state['luma']
+        self.frames = state['frames']
+
+
+def reduce_composites(parts):
+    # Pairwise tree reduction of partial composites given in frame order
+    parts = list(parts)
+    if not parts:
+        raise ValueError('No partial composites to reduce')
+    while len(parts) > 1:
+        merged = []
+        for i in range(0, len(parts) - 1, 2):
+            parts[i].merge(parts[i + 1])
+            merged.append(parts[i])
+        if len(parts) % 2:
+            merged.append(parts[-1])
+        parts = merged
+    return parts[0]
+
+
+@contextmanager
+def partial_lock(prefix):
+    # Serialize acquisition and the morning job on a partial composite
+    with open(f'{prefix}.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class IncrementalComposite(MaxLumaComposite):
+    # A MaxLumaComposite whose accumulator lives in memory-mapped .npy files
+    # next to a list of the frames already folded in, so a night can be
+    # built one frame at a time as frames are archived. Hold partial_lock
+    # while using one.
+
+    def __init__(self, prefix, height, width):
+        MaxLumaComposite.__init__(self, height, width)
+        self.prefix = prefix
+        mode = 'r+' if os.path.exists(f'{prefix}.npy') else 'w+'
+        try:
+            self.open(mode, height, width)
+        except (OSError, ValueError):
+            if mode == 'w+':
+                raise
+            # A partial missing a file, cut short or at another size is
+            # started over; the morning job folds in the frames it lacks
+            my_metrics.count('partial_composites_rebuilt')
+            discard_partial(prefix)
+            mode = 'w+'
+            self.open(mode, height, width)
+        self.folded = set()
+        if mode == 'r+' and os.path.exists(f'{prefix}.txt'):
+            with open(f'{prefix}.txt') as f:
+                self.folded = set(f.read().split())
+        self.frames = len(self.folded)
+
+    def open(self, mode, height, width):
+        self.image = open_memmap(f'{self.prefix}.npy', mode=mode,
+                                 dtype=np.uint8, shape=(height, width, 3))
+        self.luma = open_memmap(f'{self.prefix}.luma.npy', mode=mode,
+                                dtype=np.float32, shape=(height, width))
+        if self.image.shape != (height, width, 3) \
+                or self.luma.shape != (height, width):
+            raise ValueError(f'Partial composite {self.prefix} is '
+                             f'{self.image.shape}, expected '
+                             f'{(height, width, 3)}')
+
+    def fold(self, path):
+        # Add a frame file unless it is already part of the composite
+        name = os.path.basename(path)
+        if name in self.folded:
+            return False
+        self.add(load_frame(path))
+        self.flush()
+        with open(f'{self.prefix}.txt', 'a') as f:
+            f.write(f'{name}\n')
+        self.folded.add(name)
+        return True
+
+    def flush(self):
+        self.image.flush()
+        self.luma.flush()
+
+    def discard(self):
+        discard_partial(self.prefix)
+
+
+def discard_partial(prefix):
+    # Remove a night's partial composite files, if there are any. The
+    # .lock file stays: callers hold partial_lock, and a process waiting on
+    # it must lock the same file as the next one to open it.
+    for ext in ('.npy', '.luma.npy', '.txt'):
+        if os.path.exists(f'{prefix}{ext}'):
+            os.remove(f'{prefix}{ext}')
@@ -5,17 +5,23 @@ import argparse
 import fnmatch
 import json
 import logging
-import numpy as np
+import Metrics as my_metrics
 import os
 import shutil
 import Util as my_utils
 
 from datetime import date, datetime, timedelta
-from cv2 import imread, imwrite
-from PIL import Image
-
-ARCHIVE = '/data/cams'
-COMPLOC = '/data/cams/{}/composites'
+from ArchiveIndex import open_index
+from Composite import (EVENING_HOURS, MORNING_HOURS, PARTIAL,
+                       IncrementalComposite, MaxLumaComposite,
+                       discard_partial, partial_lock, reduce_composites)
+from Frames import load_frame
+from itertools import repeat
+from Pack import hour_exists, list_hour
+from Stats import drop_unreadable
+
+ARCHIVE = os.getenv('CAMSDIR', '/data/cams')
+COMPLOC = ARCHIVE + '/{}/composites'
 COMPARCH = '{}/archive/{}/{}'
 TMPDIR = '/tmp'
 TFMT = '%Y-%m-%d %H:%M'
@@ -28,6 +34,11 @@ parser.add_argument('-c', '--config', type=str, required=True,
 parser.add_argument('-d', '--date', type=str, required=False, help="yyyymmdd")
 parser.add_argument('-w', '--webcopy', type=bool, required=False, default=True,
                     help='Whether or not to copy to the web (default: true)')
+parser.add_argument('-j', '--workers', type=int, required=False, default=1,
+                    help='Number of worker processes (default: 1)')
+parser.add_argument('-i', '--incremental', action='store_true',
+                    help='Finalize the partial composite built during the '
+                         'night, if there is one')
 
 
 def read_config(configfile):
@@ -44,7 +55,65 @@ def copy_to_archive(tmpfile, path, imgname):
     shutil.copy2(tmpfile, f'{path}/{imgname}')
 
 
-def create_composite(cam, name, size, webcopy, idate=None):
+def composite_files(files, height, width):
+    # Create an empty space for the composite image
+    composite = MaxLumaComposite(height, width)
+
+    # Capture-time statistics let frames that wouldn't decode be skipped
+    # without opening them
+    for filename in drop_unreadable(files):
+        # Skip images that are empty
+        try:
+            # Log message
+            logger.debug(filename)
+
+            # Decode once, rejecting truncated/corrupt files
+            with my_metrics.timer('load'):
+                frame = load_frame(filename)
+
+            # Do the composite image calculation
+            with my_metrics.timer('add'):
+                composite.add(frame)
+            my_metrics.count('frames_composited')
+        except Exception as e:
+            logger.debug('OOPS!!!')
+            logger.debug(str(e))
+            my_metrics.count('frames_skipped', reason='error')
+            continue
+    return composite
+
+
+def parallel_composite(files, height, width, workers):
+    # Each worker composites a contiguous run of frames; merging the
+    # partials in order gives the same image as the serial path
+    from concurrent.futures import ProcessPoolExecutor
+    workers = min(workers, len(files))
+    chunk = -(-len(files) // workers)
+    chunks = [files[i:i + chunk] for i in range(0, len(files), chunk)]
+    logger.debug(f'Compositing {len(chunks)} chunks on {workers} workers')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(composite_files, chunks,
+                              repeat(height), repeat(width)))
+    return reduce_composites(parts)
+
+
+def finalize_partial(prefix, files, height, width):
+    # Catch the partial composite up on any frames acquisition missed
+    composite = IncrementalComposite(prefix, height, width)
+    logger.info(f'Finalizing partial composite of {composite.frames} frames')
+    for filename in drop_unreadable(files):
+        try:
+            if composite.fold(filename):
+                logger.debug(f'Caught up {filename}')
+        except Exception as e:
+            logger.debug('OOPS!!!')
+            logger.debug(str(e))
+    return composite
+
+
+@my_metrics.timed('total')
+def create_composite(cam, name, size, webcopy, idate=None, workers=1,
+                     incremental=False):
     logger.info('Creating composite')
     # Validate the date
     if idate and len(idate) > 0:
@@ -82,108 +151,83 @@ def create_composite(cam, name, size, webcopy, idate=None):
     logger.debug(f'startDate: {datetime.strftime(sdate, "%Y-%m-%d")}')
     logger.debug(f'endDate: {datetime.strftime(edate, "%Y-%m-%d")}')
     logger.debug(f'tmpDir: {TMPDIR}')
+    logger.debug(f'workers: {workers}')
+    logger.debug(f'incremental: {incremental}')
+
+    # Collect the night's frames in time order
+    files = []
+    index = open_index(cam)
+    if index:
+        start = datetime(syear, sdate.month, sdate.day, EVENING_HOURS[0])
+        end = datetime(eyear, edate.month, edate.day, MORNING_HOURS[-1] + 1)
+        files = index.frames(start, end, f'{name}.jpg', valid_only=True)
+        index.close()
+        # Nothing archived that night, as with a missing day directory
+        if not files:
+            return f'No indexed frames from {start.strftime(TFMT)} to ' \
+                f'{end.strftime(TFMT)}'
+    else:
+        root = f'{ARCHIVE}/{cam}/images/archive'
+        # Go through the previous and current day
+        for day in range(2):
+            # This is defining the applicable nighttime hours
+            if day == 0:
+                daydir = f'{root}/{syear}/{smonth}/{sday}'
+                hours_array = [i for i in EVENING_HOURS]
+            elif day == 1:
+                daydir = f'{root}/{eyear}/{emonth}/{eday}'
+                hours_array = [i for i in MORNING_HOURS]
+
+            # Check to see if the day directory exists
+            if not os.path.isdir(daydir):
+                return f'{daydir} does not exist'
+
+            # For each hour of this day
+            for hour in hours_array:
+                # Pad the hour with a 0 if less than 10
+                currenthour = '%02d' % hour
+
+                # Check if correct hour directory exists
+                currentdir = f'{daydir}/{currenthour}'
+                if not hour_exists(currentdir):
+                    break
+
+                # Get file list for the hour, loose or packed
+                matchname = f'*{name}.jpg'
+                files.extend(f'{currentdir}/{n}'
+                             for n in list_hour(currentdir)
+                             if fnmatch.fnmatch(n, matchname))
+
+    logger.debug(f'Found {len(files)} frames')
+    partial = PARTIAL.format(cam, f'{eyear}{emonth}{eday}', name)
+    if incremental and os.path.exists(f'{partial}.npy'):
+        with partial_lock(partial):
+            composite = finalize_partial(partial, files, height, width)
+            write_composite(composite, cam, name, webcopy, edate)
+            composite.discard()
+    else:
+        if workers > 1 and len(files) > 1:
+            composite = parallel_composite(files, height, width, workers)
+        else:
+            composite = composite_files(files, height, width)
+        write_composite(composite, cam, name, webcopy, edate)
+        # Acquisition may have built a partial for the night anyway; the
+        # full pass supersedes it
+        if os.path.exists(f'{partial}.npy'):
+            with partial_lock(partial):
+                discard_partial(partial)
 
-    # Create an empty space for the composite image
-    Amax = np.zeros((height, width, 3))
-
-    # Go through the previous and current day
-    for day in range(2):
-        # This is defining the applicable nighttime hours
-        if day == 0:
-            daydir = f'{ARCHIVE}/{cam}/images/archive/{syear}/{smonth}/{sday}'
-            hours_array = [i for i in range(20, 24)]
-        elif day == 1:
-            daydir = f'{ARCHIVE}/{cam}/images/archive/{eyear}/{emonth}/{eday}'
-            hours_array = [i for i in range(0, 5)]
-
-        # Check to see if the day directory exists
-        if not os.path.isdir(daydir):
-            return f'{daydir} does not exist'
-
-        # For each hour of this day
-        for hour in hours_array:
-            # Pad the hour with a 0 if less than 10
-            currenthour = '%02d' % hour
-
-            # Check if correct hour directory exists
-            currentdir = f'{daydir}/{currenthour}'
-            if not os.path.isdir(currentdir):
-                break
-
-            # Get file list for directory
-            matchname = f'*{name}.jpg'
-            filelist = [n for n in os.listdir(currentdir)
-                        if fnmatch.fnmatch(n, matchname)]
-            for filename in filelist:
-                # Skip images that are empty
-                try:
-                    # Log message
-                    logger.debug(filename)
-
-                    # Use image class to test file for corruption
-                    with Image.open(f'{currentdir}/{filename}') as test_img:
-                        test_img.getdata()
-
-                    # Do the composite image calculation
-                    A = imread(f'{currentdir}/{filename}')
-                    A = A.astype(float)
-                    A2 = 0.299 * A[:, :, 0] + 0.587 * A[:, :, 1] \
-                        + 0.114 * A[:, :, 2]
-                    A2 = A2.astype(float)
-                    A2max = 0.299 * Amax[:, :, 0] + 0.587 * Amax[:, :, 1] \
-                        + 0.114 * Amax[:, :, 2]
-                    A2max = A2max.astype(float)
-
-                    # Detect and ignore bad pixels
-                    Atest = np.logical_and(A2 > 127, A2 < 129)
-                    badsum = sum(sum(Atest))
-                    if badsum > 5000:
-                        for r in range(A2.shape[0]):
-                            for c in range(A2.shape[1]):
-                                if np.logical_and(A2[r, c] > 127,
-                                                  A2[r, c] < 129):
-                                    rmin = r - 5
-                                    if rmin < 0:
-                                        rmin = 0
-                                    rmax = r + 5
-                                    if rmax >= A2.shape[0]:
-                                        rmax = A2.shape[0] - 1
-                                    cmin = c - 5
-                                    if cmin < 0:
-                                        cmin = 0
-                                    cmax = c + 5
-                                    if cmax >= A2.shape[1]:
-                                        rmax = A2.shape[1] - 1
-                                    Acut = A2[rmin:rmax, cmin:cmax]
-                                    Atest2 = np.logical_and(Acut > 127,
-                                                            Acut < 129)
-                                    badsum2 = sum(sum(Atest2))
-                                    if badsum2 > 10:
-                                        A2[r, c] = 0
-
-                    m1 = (A2max >= A2) * Amax[:, :, 0]
-                    m2 = (A2max >= A2) * Amax[:, :, 1]
-                    m3 = (A2max >= A2) * Amax[:, :, 2]
-                    n1 = (A2 > A2max) * A[:, :, 0]
-                    n2 = (A2 > A2max) * A[:, :, 1]
-                    n3 = (A2 > A2max) * A[:, :, 2]
-                    p1 = m1 + n1
-                    p2 = m2 + n2
-                    p3 = m3 + n3
-                    Amax[:, :, 0] = p1
-                    Amax[:, :, 1] = p2
-                    Amax[:, :, 2] = p3
-                except Exception as e:
-                    logger.debug('OOPS!!!')
-                    logger.debug(str(e))
-                    continue
-
-    Amax = Amax.astype('uint8')
+
+def write_composite(composite, cam, name, webcopy, edate):
+    from cv2 import imwrite
+    eyear = edate.year
+    emonth = '%02d' % edate.month
+    eday = '%02d' % edate.day
 
     # Write the composite image to a file
     composite_name = f'{cam}{eyear}{emonth}{eday}{name}.jpg'
     filelocation = f'{TMPDIR}/{composite_name}'
-    imwrite(filelocation, Amax)
+    imwrite(filelocation, composite.image)
 
     # Copy to various places
     if webcopy:
@@ -213,10 +257,12 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
     config = read_config(args.config)
+    my_metrics.setup_metrics('dailycomposite', config['cam'])
     logger.info('Starting')
     # Create composite
     msg = create_composite(config['cam'], config['name'], config['size'],
-                           args.webcopy, args.date)
+                           args.webcopy, args.date, args.workers,
+                           args.incremental)
     if msg:
         logger.info(f'Error: {msg}')
     logger.info('Finished')
@@ -2,15 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import cv2
 import json
 import logging
+import Metrics as my_metrics
 import os
-import shutil
 import Util as my_utils
 
+from ArchiveIndex import open_index
+from Avi import AviTooLarge, MjpegAviWriter
+from collections import deque
 from datetime import datetime, timedelta
-from glob import glob
+from Derivatives import derivative_path, derivative_size
+from Frames import is_complete_jpeg, jpeg_size, read_frame_bytes
+from itertools import islice
+from Pack import list_tree
+
+CAMSDIR = os.getenv('CAMSDIR', '/data/cams')
+# Decoder threads, and how many frames they may decode ahead of the writer
+DECODERS = 4
+PREFETCH = 32
+FPS = 10
 
 logger = my_utils.setup_logging("DailyMovie Log")
 
@@ -40,39 +51,107 @@ def parse_date(in_date=None):
 
 
 def get_files(rootdir):
-    files = []
-    for filename in glob(f'{rootdir}/**/*.jpg', recursive=True):
-        files.append(filename)
-    return sorted(files)
+    # Loose frames and those in packed hours alike
+    return list_tree(rootdir)
+
+
+def read_image(filename):
+    # cv2.imread for frames that may live in an hour's pack; None if the
+    # frame is missing or unreadable
+    import cv2
+    import numpy as np
+    try:
+        data = read_frame_bytes(filename)
+    except OSError:
+        return None
+    if not data:
+        return None
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                        cv2.IMREAD_COLOR)
+
+
+def decode_frames(files, decoders=DECODERS, prefetch=PREFETCH):
+    # Yield decoded frames in order while up to `prefetch` later frames
+    # decode on a thread pool; cv2 releases the GIL while decoding
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=decoders) as pool:
+        remaining = iter(files)
+        pending = deque((f, pool.submit(read_image, f))
+                        for f in islice(remaining, prefetch))
+        while pending:
+            filename, future = pending.popleft()
+            for f in islice(remaining, 1):
+                pending.append((f, pool.submit(read_image, f)))
+            yield filename, future.result()
+
+
+def mux_video(files, movie, size):
+    # Copy each archive JPEG into the AVI as-is; only frames of the wrong
+    # size or with a damaged bitstream are decoded and re-encoded
+    with MjpegAviWriter(movie, size, FPS) as avi:
+        for filename in files:
+            data = read_frame_bytes(filename)
+            if is_complete_jpeg(data) and jpeg_size(data) == tuple(size):
+                avi.write(data)
+                my_metrics.count('frames_muxed')
+                continue
+            import cv2
+            import numpy as np
+            img = None
+            if data:
+                img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                                   cv2.IMREAD_COLOR)
+            if img is None:
+                logger.info(f'Skipping unreadable frame {filename}')
+                my_metrics.count('frames_skipped')
+                continue
+            logger.debug(f'Re-encoding frame {filename}')
+            my_metrics.count('frames_reencoded')
+            if img.shape[:2] != (size[1], size[0]):
+                img = cv2.resize(img, (size[0], size[1]),
+                                 interpolation=cv2.INTER_AREA)
+            avi.write(cv2.imencode('.jpg', img)[1].tobytes())
+
+
+def encode_video(files, movie, size):
+    import cv2
+    fourcc = cv2.VideoWriter_fourcc(*"MJPG")
+    video = cv2.VideoWriter(movie, fourcc, FPS, (size[0], size[1]))
+    for filename, img in decode_frames(files):
+        if img is None:
+            logger.info(f'Skipping unreadable frame {filename}')
+            continue
+        video.write(img)
+    video.release()
 
 
-def create_and_copy_video(files, tmpmovie, moviedir, goes):
-    fourcc = cv2.VideoWriter_fourcc(*"MJPG")
+def create_and_copy_video(files, movie_name, moviedir, goes, size=None):
     if goes:
-        img = cv2.imread(files[0])
+        img = read_image(files[0])
         h, w = img.shape[:2]
         size = [w, h]
-    else:
+    elif size is None:
         size = config['size']
-    video = cv2.VideoWriter(tmpmovie, fourcc, 10, (size[0], size[1]))
-    for img in files:
-        video.write(cv2.imread(img))
-    video.release()
-    # Copy movie
-    logger.info(f'Copying file to {moviedir}')
-    shutil.copy2(tmpmovie, moviedir)
-    # Delete tmp movie
-    os.remove(tmpmovie)
-
-
-def create_video(imagedir, tmpmovie, moviedir, goes=False):
-    # Get file list
-    files = get_files(imagedir)
-
+    # Write straight into the movies dir under a hidden name, then rename
+    movie = os.path.join(moviedir, movie_name)
+    tmpmovie = os.path.join(moviedir, f'.{movie_name}')
+    try:
+        with my_metrics.timer('mux'):
+            mux_video(files, tmpmovie, size)
+    except AviTooLarge as e:
+        logger.info(f'{e}; decoding and re-encoding instead')
+        with my_metrics.timer('encode'):
+            encode_video(files, tmpmovie, size)
+    logger.info(f'Writing {movie}')
+    os.replace(tmpmovie, movie)
+
+
+def create_video(files, movie_name, moviedir, goes=False, size=None):
+    my_metrics.gauge('frames', len(files))
     if len(files) > 0:
         # Create movie
         logger.debug(f'Found {len(files)} images. Starting encode.')
-        create_and_copy_video(files, tmpmovie, moviedir, goes)
+        create_and_copy_video(files, movie_name, moviedir, goes, size)
     else:
         logger.debug("No image files -- exiting")
 
@@ -81,10 +160,9 @@ def goes_video(in_date=None):
     year, month, day = parse_date(in_date)
     logger.info(f'Starting goes video creation for {year}-{month}-{day}')
     movie_name = f'goes{year}{month}{day}.avi'
-    tmp_movie = f'/tmp/{movie_name}'
     moviedir = f'/data/www/remote_sensing/goes/movies/'
     imagedir = f'/data/www/remote_sensing/goes/images/{year}/{month}/{day}'
-    create_video(imagedir, tmp_movie, moviedir, goes=True)
+    create_video(get_files(imagedir), movie_name, moviedir, goes=True)
 
 
 def cam_video(in_date=None):
@@ -94,10 +172,34 @@ def cam_video(in_date=None):
     logger.info('Starting video creation for %s, date = %s'
                 % (cam, f'{year}-{month}-{day}'))
     movie_name = f'{cam}{year}{month}{day}{name}.avi'
-    tmp_movie = f'/tmp/{movie_name}'
-    moviedir = f'/data/cams/{cam}/movies/'
-    imagedir = f'/data/cams/{cam}/images/archive/{year}/{month}/{day}'
-    create_video(imagedir, tmp_movie, moviedir)
+    moviedir = f'{CAMSDIR}/{cam}/movies/'
+    imagedir = f'{CAMSDIR}/{cam}/images/archive/{year}/{month}/{day}'
+    size = None
+
+    # Get file list, from the archive index when the camera has one
+    index = open_index(cam)
+    if index:
+        start = datetime(int(year), int(month), int(day))
+        files = index.frames(start, start + timedelta(1))
+        index.close()
+    else:
+        files = get_files(imagedir)
+
+    # Use the pre-scaled movie frames made at capture time, as long as they
+    # cover the whole day
+    spec = config.get('derivatives', {}).get('movie')
+    if spec:
+        derivdir = derivative_path(imagedir, 'movie')
+        derivs = get_files(derivdir)
+        if len(derivs) == len(files):
+            logger.debug(f'Using movie derivatives in {derivdir}')
+            files = derivs
+            size = derivative_size(config['size'], spec)
+    if size is None:
+        # Leave out frames that failed to decode at capture time
+        from Stats import drop_unreadable
+        files = drop_unreadable(files)
+    create_video(files, movie_name, moviedir, size=size)
 
 
 if __name__ == '__main__':
@@ -109,8 +211,10 @@ if __name__ == '__main__':
     if args.config:
         global config
         config = read_config(args.config)
+        my_metrics.setup_metrics('dailymovie', config['cam'])
         cam_video(args.date)
     else:
+        my_metrics.setup_metrics('dailymovie', 'goes')
         goes_video(args.date)
     logging.info('Finished creating video.')
     logging.shutdown()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import io
+import math
+
+# The web thumbnail is always made; cameras can add more (e.g. "gif" or
+# "movie") or override it with a "derivatives" config block such as
+#   {"gif": {"width": 1920}, "movie": {"scale": 0.5}}
+DEFAULT_DERIVATIVES = {'thumb': {'scale': 0.3}}
+# PIL resampling filter, by name; PIL is only imported to build derivatives
+RESAMPLE = 'BILINEAR'
+
+
+def derivative_specs(config):
+    specs = dict(DEFAULT_DERIVATIVES)
+    specs.update(config.get('derivatives', {}))
+    return specs
+
+
+def derivative_size(size, spec):
+    # Output size of a derivative of a full frame of the given size
+    w, h = size
+    if 'scale' in spec:
+        return (max(1, int(w * spec['scale'])), max(1, int(h * spec['scale'])))
+    if 'width' in spec and w > spec['width']:
+        return (spec['width'], max(1, round(h * spec['width'] / w)))
+    return (w, h)
+
+
+def derivative_path(archived, name):
+    # Derivatives mirror the archive tree under images/derivatives/<name>
+    return archived.replace('/images/archive/',
+                            f'/images/derivatives/{name}/', 1)
+
+
+def make_derivatives(content, size, specs, crop=0, stamp=None):
+    # Build every derivative from one reduced-resolution decode of the JPEG.
+    # size is the full (cropped) frame size, crop the rows cut from the
+    # bottom of the source, and stamp(im, factor) marks each output.
+    from PIL import Image
+    targets = {name: derivative_size(size, spec)
+               for name, spec in specs.items()}
+    if not targets:
+        return {}
+    factor = max(t[0] / size[0] for t in targets.values())
+    out = {}
+    with Image.open(io.BytesIO(content)) as im:
+        sw, sh = im.size
+        # libjpeg scales by 1/2, 1/4 or 1/8 during the IDCT; ask for the
+        # smallest scale that is still at least as large as every target
+        im.draft('RGB', (math.ceil(sw * factor), math.ceil(sh * factor)))
+        k = sw / im.size[0]
+        src = im.convert('RGB') if im.mode != 'RGB' else im
+        if crop:
+            w, h = src.size
+            src = src.crop((0, 0, w, h - round(crop / k)))
+        for name, target in targets.items():
+            d = src.resize(target, getattr(Image, RESAMPLE))
+            if stamp:
+                stamp(d, target[0] / size[0])
+            out[name] = d
+    return out
+
+
+def encode_jpeg(im):
+    buf = io.BytesIO()
+    im.save(buf, 'JPEG')
+    return buf.getvalue()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+
+from Pack import read_member
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+# Start-of-frame markers (everything from C0 to CF but DHT, JPG and DAC)
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Some cameras pad the bitstream after EOI, so look for it near the end
+EOI_TAIL = 64
+# Bytes read from the start of a file to find its SOF header
+PROBE_HEAD = 65536
+
+
+def read_frame_bytes(path):
+    # Frames of packed hours are read from the hour's pack
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return read_member(path)
+
+
+def is_complete_jpeg(data):
+    # Cheap structural check: SOI at the start, EOI at the (padded) end.
+    # Catches the empty and truncated files a partial upload leaves behind.
+    if len(data) < 4 or data[:2] != JPEG_SOI:
+        return False
+    return bytes(data[-EOI_TAIL:]).rstrip(b'\x00').endswith(JPEG_EOI)
+
+
+def jpeg_size(data):
+    # (width, height) from the first SOF marker, without decoding
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if marker in SOF_MARKERS:
+            h, w = struct.unpack('>HH', data[i + 5:i + 9])
+            return (w, h)
+        i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return None
+
+
+def probe_frame(path):
+    # (size, width, height, valid) from the file's head and tail only
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            head = f.read(PROBE_HEAD)
+            tail = head
+            if size > PROBE_HEAD:
+                f.seek(-EOI_TAIL, os.SEEK_END)
+                tail = f.read(EOI_TAIL)
+    except FileNotFoundError:
+        data = read_member(path)
+        size = len(data)
+        head = data[:PROBE_HEAD]
+        tail = data[-EOI_TAIL:]
+    dims = jpeg_size(head) or (None, None)
+    valid = len(head) >= 4 and head[:2] == JPEG_SOI \
+        and tail.rstrip(b'\x00').endswith(JPEG_EOI) and dims[0] is not None
+    return size, dims[0], dims[1], valid
+
+
+def decode_frame(data):
+    # cv2 and numpy are only needed to decode; the header helpers above
+    # stay cheap to import
+    import numpy as np
+    from cv2 import IMREAD_COLOR, imdecode
+    if not is_complete_jpeg(data):
+        raise ValueError('Truncated or corrupt JPEG')
+    frame = imdecode(np.frombuffer(data, dtype=np.uint8), IMREAD_COLOR)
+    if frame is None:
+        raise ValueError('Unable to decode JPEG')
+    return frame
+
+
+def load_frame(path):
+    # Read and decode a frame once, returning a BGR uint8 array
+    return decode_frame(read_frame_bytes(path))
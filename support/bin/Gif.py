@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+import Metrics as my_metrics
+import numpy as np
+
+from Frames import is_complete_jpeg, read_frame_bytes
+from PIL import Image, ImageDraw
+
+# Palette entry kept free for "unchanged since the previous frame"
+TRANSPARENT = 255
+COLORS = 255
+# Colors are binned at 5 bits per channel to build the palette
+BITS = 5
+
+logger = logging.getLogger('MakeGif')
+
+
+def load_frame(path, max_width=None, blackout=()):
+    # Decode (at reduced resolution when shrinking), resize to max_width
+    # and black out rectangles given as [x0, y0, x1, y1], inclusive
+    data = read_frame_bytes(path)
+    if not is_complete_jpeg(data):
+        raise ValueError(f'Truncated or corrupt JPEG: {path}')
+    with Image.open(io.BytesIO(data)) as im:
+        if max_width and im.size[0] > max_width:
+            w, h = im.size
+            size = (max_width, round(h * max_width / w))
+            im.draft('RGB', size)
+            im = im.convert('RGB').resize(size, Image.BILINEAR)
+        else:
+            im = im.convert('RGB')
+    if blackout:
+        draw = ImageDraw.Draw(im)
+        for rect in blackout:
+            draw.rectangle(list(rect), fill='black')
+    return np.asarray(im)
+
+
+def color_bins(frame):
+    shift = 8 - BITS
+    r, g, b = (frame[:, :, i] >> shift for i in range(3))
+    return (r.astype(np.uint16) << 2 * BITS) | (g.astype(np.uint16) << BITS) \
+        | b
+
+
+class PaletteBuilder(object):
+    # Shared palette for all frames: the COLORS most common color bins,
+    # each represented by the mean of the pixels that fell in it
+
+    def __init__(self):
+        n = 1 << 3 * BITS
+        self.counts = np.zeros(n, dtype=np.int64)
+        self.sums = np.zeros((n, 3), dtype=np.float64)
+
+    def add(self, frame):
+        bins = color_bins(frame).ravel()
+        n = len(self.counts)
+        self.counts += np.bincount(bins, minlength=n)
+        for i in range(3):
+            self.sums[:, i] += np.bincount(bins, frame[:, :, i].ravel(),
+                                           minlength=n)
+        return bins.reshape(frame.shape[:2])
+
+    def build(self):
+        used = np.flatnonzero(self.counts)
+        top = used[np.argsort(self.counts[used])[::-1][:COLORS]]
+        palette = self.sums[top] / self.counts[top, None]
+        # Map every bin to its nearest palette color, once
+        shift = 8 - BITS
+        n = np.arange(len(self.counts))
+        centers = np.stack([(n >> 2 * BITS) & 31, (n >> BITS) & 31,
+                            n & 31], axis=1) << shift
+        centers = centers + (1 << shift) // 2
+        lut = np.empty(len(n), dtype=np.uint8)
+        for start in range(0, len(n), 4096):
+            block = centers[start:start + 4096, None, :] - palette[None]
+            lut[start:start + 4096] = np.argmin((block ** 2).sum(axis=2),
+                                                axis=1)
+        lut[top] = np.arange(len(top), dtype=np.uint8)
+        return np.rint(palette).astype(np.uint8), lut
+
+
+def write_gif(paths, out, max_width=None, blackout=(), delay=15):
+    # delay is in hundredths of a second, as with ImageMagick's -delay.
+    # Frames that can't be decoded are left out rather than failing the
+    # whole GIF.
+    builder = PaletteBuilder()
+    bins = []
+    for p in paths:
+        try:
+            frame = load_frame(p, max_width, blackout)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Leaving {p} out of the gif: {e}')
+            my_metrics.count('frames_skipped', reason='unreadable')
+            continue
+        bins.append(builder.add(frame))
+    if not bins:
+        raise ValueError('No readable frames')
+    palette, lut = builder.build()
+    flat = np.zeros((256, 3), dtype=np.uint8)
+    flat[:len(palette)] = palette
+
+    frames = []
+    previous = None
+    for b in bins:
+        indexed = lut[b]
+        coded = indexed
+        if previous is not None:
+            # Pixels that didn't change show through from the last frame
+            coded = indexed.copy()
+            coded[indexed == previous] = TRANSPARENT
+        previous = indexed
+        im = Image.fromarray(coded, 'P')
+        im.putpalette(flat.tobytes())
+        frames.append(im)
+    frames[0].save(out, 'GIF', save_all=True, append_images=frames[1:],
+                   duration=delay * 10, loop=0, transparency=TRANSPARENT,
+                   disposal=1, optimize=False)
+    return len(frames)
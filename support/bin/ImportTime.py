@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+import Util as my_utils
+
+from collections import defaultdict
+
+BIN = os.path.dirname(os.path.abspath(__file__))
+MODULES = ('CamAcq', 'DailyComposite', 'DailyMovie', 'MakeGif', 'PruneData',
+           'Pack', 'ArchiveIndex', 'Scheduler', 'Frames')
+# Startup budgets: milliseconds to import the module, and packages it must
+# not import before it needs them. A cron capture imported CamAcq in
+# 335 ms when requests, PIL, numpy and asyncio loaded up front, and in
+# 25 ms with them deferred; the budget leaves room for slower hosts.
+# Frames decodes with numpy and cv2 but is imported for its header helpers
+# by scripts that never decode.
+BUDGETS = {
+    'CamAcq': (60, ('requests', 'PIL', 'numpy', 'cv2', 'asyncio')),
+    'Frames': (40, ('numpy', 'cv2')),
+}
+RUNS = 5
+
+logger = logging.getLogger("ImportTime Log")
+
+parser = argparse.ArgumentParser(
+    description='Import-time report for the entry points, from '
+                'python -X importtime')
+parser.add_argument('modules', nargs='*',
+                    help=f"Modules to report on (default: "
+                         f"{' '.join(MODULES)})")
+parser.add_argument('-n', '--top', type=int, default=10,
+                    help='Packages to list per module (default: 10)')
+parser.add_argument('-r', '--runs', type=int, default=RUNS,
+                    help=f'Imports per module; the fastest is reported '
+                         f'(default: {RUNS})')
+parser.add_argument('--check', action='store_true',
+                    help='Exit non-zero if a module is over its budget')
+
+
+def import_times(module):
+    # Rows of -X importtime for `import module` in a fresh interpreter, as
+    # (self us, cumulative us, name), and the wall time of the whole run.
+    # Only the module's own import tree is kept, not the site imports the
+    # interpreter made first.
+    started = time.perf_counter()
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                        f'import {module}'], cwd=BIN,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wall = time.perf_counter() - started
+    if p.returncode:
+        raise RuntimeError(f'Unable to import {module}: '
+                           f'{p.stderr.decode().strip().splitlines()[-1]}')
+    rows = []
+    for line in p.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        # Rows come children first; a top-level name ends a tree
+        if not name.startswith('  ') and name.strip() != module:
+            rows = []
+            continue
+        rows.append((int(own), int(cumulative), name.strip()))
+        if name.strip() == module:
+            break
+    return rows, wall
+
+
+def fastest(module, runs):
+    # The run whose import of module itself took least
+    best = None
+    for _ in range(runs):
+        rows, wall = import_times(module)
+        total = rows[-1][1]
+        if best is None or total < best[0]:
+            best = (total, rows, wall)
+    return best
+
+
+def by_package(rows):
+    # Self time per top-level package, heaviest first
+    totals = defaultdict(int)
+    for own, _, name in rows:
+        totals[name.split('.')[0]] += own
+    return sorted(totals.items(), key=lambda t: t[1], reverse=True)
+
+
+def report(module, runs, top):
+    # Log the module's import time and heaviest packages; returns the
+    # budget violations
+    total, rows, wall = fastest(module, runs)
+    logger.info(f'{module}: {total / 1000:.1f} ms to import, '
+                f'{wall * 1000:.0f} ms with interpreter startup, '
+                f'{len(rows)} modules')
+    for package, own in by_package(rows)[:top]:
+        logger.info(f'    {package:<24} {own / 1000:8.1f} ms')
+    problems = []
+    if module in BUDGETS:
+        budget, deferred = BUDGETS[module]
+        if total > budget * 1000:
+            problems.append(f'{module} took {total / 1000:.1f} ms to import, '
+                            f'budget {budget} ms')
+        loaded = {name.split('.')[0] for _, _, name in rows}
+        for package in deferred:
+            if package in loaded:
+                problems.append(f'{module} imports {package} at startup')
+    return problems
+
+
+if __name__ == '__main__':
+    logger = my_utils.setup_logging("ImportTime Log")
+    if 'PYLOGLEVEL' in os.environ:
+        level = logging.getLevelName(os.getenv('PYLOGLEVEL', 'DEBUG'))
+        logger.setLevel(level)
+
+    args = parser.parse_args()
+    logger.info('Starting')
+    problems = []
+    for module in args.modules or MODULES:
+        problems.extend(report(module, args.runs, args.top))
+    for problem in problems:
+        logger.error(problem)
+    logger.info('Finished')
+    logging.shutdown()
+    if args.check and problems:
+        sys.exit(1)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import Metrics as my_metrics
+import threading
+
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Live view for the acquisition daemons: the latest frame, thumbnail and
+# capture time of every camera, kept in memory and served over HTTP.
+#   GET /                    cameras and their latest capture times (JSON)
+#   GET /<cam>/latest.jpg    latest frame; ETag and If-Modified-Since
+#   GET /<cam>/thumb.jpg     its thumbnail, likewise
+#   GET /<cam>/latest.json   capture time, size and ETag of the latest frame
+#   GET /<cam>/stream.mjpg   MJPEG push stream (?thumb for thumbnails)
+BOUNDARY = b'liveframe'
+# Seconds a stream waits for a frame before checking the client is there
+KEEPALIVE = 30
+MAX_STREAMS = 64
+TFMT = '%Y-%m-%d %H:%M:%S'
+
+logger = logging.getLogger("CamAcq Log")
+
+
+class LiveFrame(object):
+    # One camera's latest capture
+    __slots__ = ('full', 'thumb', 'time', 'seq', 'etag', 'modified')
+
+    def __init__(self, full, thumb, tm, seq):
+        self.full = full
+        self.thumb = thumb
+        self.time = tm
+        self.seq = seq
+        self.etag = f'"{int(tm.timestamp()):x}-{seq:x}"'
+        self.modified = formatdate(tm.timestamp(), usegmt=True)
+
+
+class LiveStore(object):
+    # Latest frame per camera. Streams wait on the condition for the next
+    # publish rather than polling.
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.frames = {}
+        self.seq = 0
+
+    def publish(self, cam, full, thumb, tm):
+        with self.cond:
+            self.seq += 1
+            self.frames[cam] = LiveFrame(full, thumb, tm, self.seq)
+            self.cond.notify_all()
+
+    def latest(self, cam):
+        with self.cond:
+            return self.frames.get(cam)
+
+    def cameras(self):
+        with self.cond:
+            return dict(self.frames)
+
+    def wait(self, cam, seq, timeout):
+        # The camera's frame once it is newer than seq, or None on timeout
+        def newer():
+            frame = self.frames.get(cam)
+            return frame is not None and frame.seq != seq
+        with self.cond:
+            if self.cond.wait_for(newer, timeout):
+                return self.frames[cam]
+            return None
+
+
+class LiveServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, store, port, host=''):
+        super().__init__((host, port), LiveHandler)
+        self.store = store
+        self.lock = threading.Lock()
+        self.streams = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        logger.info(f'Live view on port {self.server_address[1]}')
+        return self
+
+
+class LiveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        logger.debug(f'Live view: {fmt % args}')
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        parts = path.strip('/').split('/')
+        store = self.server.store
+        if parts == ['']:
+            self.send_index(store.cameras())
+            return
+        frame = store.latest(parts[0]) if len(parts) == 2 else None
+        if frame is None:
+            self.reply(404, b'No such camera', 'text/plain')
+        elif parts[1] == 'latest.jpg':
+            self.send_frame(frame, frame.full)
+        elif parts[1] == 'thumb.jpg':
+            self.send_frame(frame, frame.thumb)
+        elif parts[1] == 'latest.json':
+            self.send_frame(frame, json.dumps(describe(frame)).encode(),
+                            'application/json')
+        elif parts[1] == 'stream.mjpg':
+            self.stream(parts[0], 'thumb' in query.split('&'))
+        else:
+            self.reply(404, b'Not found', 'text/plain')
+
+    def send_index(self, frames):
+        body = json.dumps({cam: describe(frame)
+                           for cam, frame in sorted(frames.items())})
+        self.reply(200, body.encode(), 'application/json')
+
+    def not_modified(self, frame):
+        # If-None-Match wins over If-Modified-Since, as RFC 7232 has it
+        tags = self.headers.get('If-None-Match')
+        if tags is not None:
+            return tags.strip() == '*' or frame.etag in \
+                [t.strip() for t in tags.split(',')]
+        since = self.headers.get('If-Modified-Since')
+        if since is None:
+            return False
+        try:
+            since = parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # Last-Modified has whole seconds
+        return int(frame.time.timestamp()) <= since
+
+    def send_frame(self, frame, body, ctype='image/jpeg'):
+        headers = {'ETag': frame.etag, 'Last-Modified': frame.modified,
+                   'Cache-Control': 'no-cache'}
+        if self.not_modified(frame):
+            my_metrics.count('live_requests', status=304)
+            self.reply(304, b'', None, headers)
+        else:
+            my_metrics.count('live_requests', status=200)
+            self.reply(200, body, ctype, headers)
+
+    def reply(self, status, body, ctype, headers=None):
+        self.send_response(status)
+        if ctype:
+            self.send_header('Content-Type', ctype)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def stream(self, cam, thumb):
+        # Push every new frame as one part of a multipart response. The
+        # current frame goes first so viewers see something at once.
+        server = self.server
+        with server.lock:
+            if server.streams >= MAX_STREAMS:
+                self.reply(503, b'Too many streams', 'text/plain')
+                return
+            server.streams += 1
+            my_metrics.gauge('live_streams', server.streams)
+        self.close_connection = True
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; '
+                             f'boundary={BOUNDARY.decode()}')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            seq = None
+            while True:
+                frame = server.store.wait(cam, seq, KEEPALIVE)
+                if frame is None:
+                    # Nothing new; resending the frame finds dead clients
+                    frame = server.store.latest(cam)
+                    if frame is None:
+                        continue
+                seq = frame.seq
+                data = frame.thumb if thumb else frame.full
+                self.wfile.write(b''.join([
+                    b'--', BOUNDARY, b'\r\n',
+                    b'Content-Type: image/jpeg\r\n',
+                    b'Content-Length: %d\r\n\r\n' % len(data),
+                    data, b'\r\n']))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with server.lock:
+                server.streams -= 1
+                my_metrics.gauge('live_streams', server.streams)
+
+
+def describe(frame):
+    return {'time': frame.time.strftime(TFMT), 'etag': frame.etag,
+            'bytes': len(frame.full), 'thumb_bytes': len(frame.thumb)}
+
+
+def serve(port, host=''):
+    # Start a live view on a daemon thread; returns the store to fill
+    store = LiveStore()
+    LiveServer(store, port, host).start()
+    return store
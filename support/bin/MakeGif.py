@@ -3,113 +3,162 @@
 
 import argparse
 import logging
+import Metrics as my_metrics
 import os
-import shutil
+import resource
 import subprocess
+import time
 import Util as my_utils
 
+from ArchiveIndex import open_index
 from datetime import datetime, timedelta
-from glob import glob
+from Derivatives import derivative_path
+from Pack import exists, hour_exists, list_hour
 
 TM_FORMAT = '%Y-%m-%d %H:%M:%S'
 DIR = os.getenv('CAMSDIR', '/data/cams')
-YR_PATH = '{}/{}/images/archive/{}'
-TMP = '/tmp/gif'
+HOUR_PATH = '{}/{}/images/archive/{}/{}/{}/{}'
+# Defaults for a camera config's "gif" block: max_width, delay (1/100 s)
+# and blackout, a list of [x0, y0, x1, y1] rectangles
+MAX_WIDTH = 1920
+DELAY = 15
+# SPARTAN logo blackout for configs that predate the "gif" block
+LEGACY_BLACKOUT = {cam: [[0, 930, 140, 960]]
+                   for cam in ['L3cam', 'L4cam', 'L8cam', 'LPcam']}
 
 logger = my_utils.setup_logging('MakeGif')
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--config', type=str, required=True,
                     help='Config file')
-
-
-def get_hours(st, et):
-    hours = {}
-    if et.day == st.day:
-        hours[str(et.day).zfill(2)] = [str(x).zfill(2)
-                                       for x in range(st.hour, et.hour + 1)]
-    else:
-        hours[str(st.day).zfill(2)] = [str(x).zfill(2)
-                                       for x in range(st.hour, 24)]
-        hours[str(et.day).zfill(2)] = [str(x).zfill(2)
-                                       for x in range(0, et.hour + 1)]
-    return hours
+parser.add_argument('-e', '--engine', choices=['native', 'imagemagick'],
+                    default='native',
+                    help='GIF engine (default: native)')
+
+
+def earliest_frame(path):
+    # Name of the first *.jpg of an hour, loose or packed, or None
+    if not hour_exists(path):
+        raise FileNotFoundError(path)
+    names = list_hour(path)
+    return names[0] if names else None
+
+
+def hour_frames(cam, start, now):
+    # Earliest archive frame of each hour from start through now
+    index = open_index(cam)
+    if index:
+        end = now.replace(minute=0, second=0, microsecond=0)
+        frames = index.first_per_hour(start, end + timedelta(hours=1))
+        index.close()
+        return frames
+    t = start
+    frames = []
+    while t <= now:
+        p = HOUR_PATH.format(DIR, cam, t.year, str(t.month).zfill(2),
+                             str(t.day).zfill(2), str(t.hour).zfill(2))
+        t += timedelta(hours=1)
+        try:
+            first = earliest_frame(p)
+        except FileNotFoundError:
+            logger.info(f'Directory doesn\'t exist: {p}')
+            continue
+        if first is None:
+            logger.info(f'No images in directory: {p}')
+            continue
+        frames.append(f'{p}/{first}')
+    return frames
+
+
+def select_frames(cam, now=None):
+    # Earliest frame of each hour from this hour yesterday through now
+    now = now or datetime.now()
+    t = (now - timedelta(days=1)).replace(minute=0, second=0, microsecond=0)
+    frames = []
+    for frame in hour_frames(cam, t, now):
+        # Prefer the GIF-sized copy made at capture time
+        src = derivative_path(frame, 'gif')
+        if not exists(src):
+            src = frame
+        logger.debug(f'Selected {src}')
+        frames.append(src)
+    return frames
 
 
 def gather_images():
     cam = config['cam']
-    now = datetime.now()
-    st = now - timedelta(days=1)
     logger.info(f'Gather images for {cam}.')
-    months = {}
-    if now.month == st.month:
-        months[str(now.month).zfill(2)] = get_hours(st, now)
-    else:
-        months[str(st.month).zfill(2)] = get_hours(st,
-                                                   datetime(st.year,
-                                                            st.month,
-                                                            st.day, 23, 30))
-        months[str(now.month).zfill(2)] = get_hours(datetime(now.year,
-                                                             now.month,
-                                                             now.day, 00,
-                                                             30), now)
-    count = 0
-    ypath = YR_PATH.format(DIR, cam, now.year)
-    if not os.path.exists(f'{TMP}/{cam}'):
-        os.makedirs(f'{TMP}/{cam}')
-    for mkey, mval in months.items():
-        for dkey, dval in mval.items():
-            for h in dval:
-                p = f'{ypath}/{mkey.zfill(2)}/{dkey.zfill(2)}/{h.zfill(0)}'
-                if os.path.exists(p):
-                    os.chdir(p)
-                    logger.info(f'Grabbing files from {os.getcwd()}')
-                    imgs = glob('*.jpg')
-                    if imgs:
-                        shutil.copy2(sorted(imgs)[0], f'{TMP}/{cam}')
-                        count += 1
-                    else:
-                        logger.info('No images in directory.')
-                else:
-                    logger.info('Directory doesn\'t exist.')
-    return count
-
-
-def create_gif():
-    os.chdir(f'{TMP}/{config["cam"]}')
-    imgs = sorted(glob('*.jpg'))
-    if imgs:
-        if config['size'][0] > 1920:
-            logger.info('Downsizing large images.')
-            cmd = ['mogrify', '-resize', '1920', '*.jpg']
-            subprocess.call(cmd)
-        if config['cam'] in ['L3cam', 'L4cam', 'L8cam', 'LPcam']:
-            logger.info('Blacking out SPARTAN logo')
-            rect = 'rectangle 0,930,140,960'
-            cmd = ['mogrify', '-fill', 'black', '-draw',
-                   rect, '*.jpg']
-            subprocess.call(cmd)
+    return select_frames(cam)
+
+
+def gif_settings():
+    gif = config.get('gif', {})
+    max_width = gif.get('max_width', MAX_WIDTH)
+    blackout = gif.get('blackout', LEGACY_BLACKOUT.get(config['cam'], []))
+    delay = gif.get('delay', DELAY)
+    return max_width, blackout, delay
+
+
+def create_gif_imagemagick(imgs, out, max_width, blackout, delay):
+    # One convert over the archive frames; shrink-only resize. Frames of
+    # packed hours have no file of their own, so they are copied out to a
+    # scratch directory for convert to read. Frames that are gone, like
+    # empty ones packing dropped, are left out.
+    import tempfile
+    from Frames import read_frame_bytes
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for i, img in enumerate(imgs):
+            if not os.path.exists(img):
+                try:
+                    data = read_frame_bytes(img)
+                except FileNotFoundError:
+                    logger.info(f'Frame is gone, leaving it out: {img}')
+                    continue
+                path = f'{tmpdir}/{i:04d}.jpg'
+                with open(path, 'wb') as f:
+                    f.write(data)
+                logger.debug(f'Unpacked {img}')
+                img = path
+            paths.append(img)
+        if not paths:
+            raise ValueError('No frames left to make a gif of')
+        cmd = ['convert', '-delay', str(delay)] + paths
+        cmd += ['-resize', f'{max_width}>']
+        if blackout:
+            logger.info('Blacking out logo')
+            cmd += ['-fill', 'black']
+            for x0, y0, x1, y1 in blackout:
+                cmd += ['-draw', f'rectangle {x0},{y0},{x1},{y1}']
         logger.info('Creating gif')
-        cmd = ['convert', '+dither', '-layers', 'Optimize', '-delay', '15',
-               '*.jpg', f'{config["cam"]}.gif']
-        subprocess.call(cmd)
-    else:
-        logger.info('No images, quitting')
+        cmd += ['+dither', '-layers', 'Optimize', out]
+        subprocess.check_call(cmd)
 
 
-def copy_to_server():
-    logger.info('Copying to lamp')
+def create_gif(imgs, engine='native'):
+    # Build under a hidden name in the web dir, then rename into place
     cam = config['cam']
-    shutil.copy2(f'{TMP}/{cam}/{cam}.gif', f'{DIR}/{cam}/images')
-
-
-def cleanup():
-    os.chdir(f'{TMP}/{config["cam"]}')
-    logger.info('Cleaning up')
-    os.remove(f'{config["cam"]}.gif')
-    files = glob('*.jpg*')
-    for f in files:
-        os.remove(f)
+    gif = f'{DIR}/{cam}/images/{cam}.gif'
+    tmpgif = f'{DIR}/{cam}/images/.{cam}.gif'
+    max_width, blackout, delay = gif_settings()
+    started = time.time()
+    if engine == 'imagemagick':
+        create_gif_imagemagick(imgs, tmpgif, max_width, blackout, delay)
+        who = resource.RUSAGE_CHILDREN
+    else:
+        from Gif import write_gif
+        logger.info('Creating gif')
+        write_gif(imgs, tmpgif, max_width, blackout, delay)
+        who = resource.RUSAGE_SELF
+    # ru_maxrss is in kilobytes on Linux
+    rss = resource.getrusage(who).ru_maxrss / 1024
+    elapsed = time.time() - started
+    logger.info(f'{engine} gif of {len(imgs)} frames took '
+                f'{elapsed:.2f}s, peak RSS {rss:.0f} MB')
+    my_metrics.observe('stage_seconds', elapsed, stage='gif', engine=engine)
+    my_metrics.gauge('peak_rss_mb', rss, engine=engine)
+    logger.info('Copying to lamp')
+    os.replace(tmpgif, gif)
 
 
 if __name__ == '__main__':
@@ -121,11 +170,12 @@ if __name__ == '__main__':
     logger.info('Starting')
     global config
     config = my_utils.read_json_config(args.config)
-    count = gather_images()
-    if count > 0:
-        create_gif()
-        copy_to_server()
-        cleanup()
+    my_metrics.setup_metrics('makegif', config['cam'])
+    with my_metrics.timer('select'):
+        frames = gather_images()
+    my_metrics.gauge('frames', len(frames))
+    if frames:
+        create_gif(frames, args.engine)
     else:
         logger.info('No images collected.')
     logger.info('Finished')
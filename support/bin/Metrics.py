@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+import Util as my_utils
+
+# Metrics are off unless CAMMETRICS names a directory to write them to.
+# CAMMETRICS_FORMAT picks a Prometheus textfile ("prom", rewritten with a
+# snapshot on every flush, for node_exporter's textfile collector) or JSON
+# lines ("jsonl", one snapshot appended per flush). CAMPROFILE names a
+# directory for a cProfile dump of the whole run.
+PREFIX = 'cams'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300, float('inf'))
+# Long-running processes flush at most this often, in seconds
+FLUSH_INTERVAL = 60
+
+_registry = None
+_profile = None
+
+
+class Registry(object):
+    # Counters, gauges and histograms keyed by (name, labels), with the
+    # job and instance labels added to everything on output
+
+    def __init__(self, job, instance, directory, fmt):
+        self.job = job
+        self.instance = instance
+        self.directory = directory
+        self.fmt = fmt
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.flushed = time.time()
+
+    def count(self, name, n, labels):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, value, labels):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels):
+        key = (name, labels)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            h[0][bisect.bisect_left(BUCKETS, value)] += 1
+            h[1] += value
+            h[2] += 1
+
+    @property
+    def path(self):
+        name = self.job if not self.instance \
+            else f'{self.job}_{self.instance}'
+        return os.path.join(self.directory, f'{name}.{self.fmt}')
+
+    def flush(self):
+        with self.lock:
+            if not self.directory:
+                pass
+            elif self.fmt == 'prom':
+                data = self.prometheus()
+                my_utils.write_atomic(self.path, data.encode())
+            else:
+                data = json.dumps(self.snapshot(), default=float) + '\n'
+                fd = os.open(self.path,
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, data.encode())
+                finally:
+                    os.close(fd)
+            self.flushed = time.time()
+
+    def _labels(self, labels, **extra):
+        items = [('job', self.job)]
+        if self.instance:
+            items.append(('instance', self.instance))
+        items.extend(labels)
+        items.extend(extra.items())
+        return items
+
+    def snapshot(self):
+        def entry(name, labels, **values):
+            out = {'name': f'{PREFIX}_{name}'}
+            out.update(labels)
+            out.update(values)
+            return out
+        return {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'job': self.job,
+            'instance': self.instance,
+            'counters': [entry(n, dict(l), value=v)
+                         for (n, l), v in sorted(self.counters.items())],
+            'gauges': [entry(n, dict(l), value=v)
+                       for (n, l), v in sorted(self.gauges.items())],
+            'histograms': [entry(n, dict(l), count=h[2], sum=h[1],
+                                 buckets=h[0][:-1])
+                           for (n, l), h in sorted(self.histograms.items())],
+            'le': list(BUCKETS[:-1]),
+        }
+
+    def prometheus(self):
+        def fmt(name, labels):
+            inner = ','.join(f'{k}="{v}"' for k, v in labels)
+            return f'{PREFIX}_{name}{{{inner}}}'
+        lines = []
+        for kind, metrics in (('counter', self.counters),
+                              ('gauge', self.gauges)):
+            seen = set()
+            for (name, labels), v in sorted(metrics.items()):
+                full = f'{name}_total' if kind == 'counter' else name
+                if full not in seen:
+                    lines.append(f'# TYPE {PREFIX}_{full} {kind}')
+                    seen.add(full)
+                lines.append(f'{fmt(full, self._labels(labels))} {v}')
+        seen = set()
+        for (name, labels), (buckets, total, n) in \
+                sorted(self.histograms.items()):
+            if name not in seen:
+                lines.append(f'# TYPE {PREFIX}_{name} histogram')
+                seen.add(name)
+            cumulative = 0
+            for le, c in zip(BUCKETS, buckets):
+                cumulative += c
+                le = '+Inf' if le == float('inf') else repr(le)
+                bucket = fmt(f'{name}_bucket', self._labels(labels, le=le))
+                lines.append(f'{bucket} {cumulative}')
+            lines.append(f'{fmt(f"{name}_sum", self._labels(labels))} '
+                         f'{total}')
+            lines.append(f'{fmt(f"{name}_count", self._labels(labels))} {n}')
+        return '\n'.join(lines) + '\n'
+
+
+def setup_metrics(job, instance=None, in_memory=False):
+    # Called from a script's __main__. Without CAMMETRICS or CAMPROFILE
+    # every call below returns at once, unless in_memory asks for the
+    # metrics to be kept anyway, for a process that reads them back with
+    # snapshot().
+    global _registry, _profile
+    directory = os.getenv('CAMMETRICS')
+    if in_memory and not directory:
+        _registry = Registry(job, instance, None, None)
+    if directory:
+        fmt = os.getenv('CAMMETRICS_FORMAT', 'jsonl')
+        if fmt not in ('prom', 'jsonl'):
+            raise ValueError(f'Unknown CAMMETRICS_FORMAT: {fmt}')
+        os.makedirs(directory, exist_ok=True)
+        _registry = Registry(job, instance, directory, fmt)
+        atexit.register(flush)
+    profile_dir = os.getenv('CAMPROFILE')
+    if profile_dir and _profile is None:
+        import cProfile
+        os.makedirs(profile_dir, exist_ok=True)
+        name = job if not instance else f'{job}_{instance}'
+        path = os.path.join(profile_dir, f'{name}.{os.getpid()}.prof')
+        _profile = cProfile.Profile()
+        _profile.enable()
+        atexit.register(_dump_profile, path)
+    return _registry is not None
+
+
+def _dump_profile(path):
+    _profile.disable()
+    _profile.dump_stats(path)
+
+
+def enabled():
+    return _registry is not None
+
+
+def snapshot():
+    # Current values, as a jsonl flush would write them, or None when
+    # metrics are off
+    if _registry is None:
+        return None
+    with _registry.lock:
+        return _registry.snapshot()
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def count(name, n=1, **labels):
+    if _registry is not None:
+        _registry.count(name, n, _key(labels))
+
+
+def gauge(name, value, **labels):
+    if _registry is not None:
+        _registry.gauge(name, value, _key(labels))
+
+
+def observe(name, value, **labels):
+    if _registry is not None:
+        _registry.observe(name, value, _key(labels))
+
+
+class _Timer(object):
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _registry.observe(self.name, time.perf_counter() - self.started,
+                          self.labels)
+        return False
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullTimer()
+
+
+def timer(stage, **labels):
+    # with timer('fetch', cam=cam): ... records the block's duration in the
+    # stage_seconds histogram
+    if _registry is None:
+        return _NULL
+    labels['stage'] = stage
+    return _Timer('stage_seconds', _key(labels))
+
+
+def timed(stage):
+    # Decorator form of timer()
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if _registry is None:
+                return fn(*args, **kwargs)
+            with timer(stage):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def flush():
+    if _registry is not None:
+        _registry.flush()
+
+
+def maybe_flush():
+    # For daemons: flush if FLUSH_INTERVAL has passed since the last one
+    if _registry is not None \
+            and time.time() - _registry.flushed >= FLUSH_INTERVAL:
+        _registry.flush()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import io
+import json
+import logging
+import mmap
+import os
+import tarfile
+import threading
+import time
+import Util as my_utils
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from glob import glob
+
+ARCHIVE = os.getenv('CAMSDIR', '/data/cams')
+# Hour directories packed by default: the archive and every derivative
+TREES = ('{}/{}/images/archive', '{}/{}/images/derivatives/*')
+# A finished hour YYYY/MM/DD/HH becomes YYYY/MM/DD/HH.tar, plus an index of
+# member offsets in HH.tar.idx
+PACK_SUFFIX = '.tar'
+INDEX_SUFFIX = '.idx'
+# Hours are packed once they ended at least this many hours ago
+MIN_AGE = 2
+# Packs kept memory-mapped per process
+OPEN_PACKS = 16
+
+logger = logging.getLogger("Pack Log")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--cam', type=str, required=True, help='Camera code')
+parser.add_argument('-a', '--min-age', type=int, default=MIN_AGE,
+                    help=f'Only pack hours that ended at least this many '
+                         f'hours ago (default: {MIN_AGE})')
+parser.add_argument('-n', '--dry-run', action='store_true',
+                    help='List the hours that would be packed')
+
+_packs = OrderedDict()
+_lock = threading.Lock()
+
+
+class HourPack(object):
+    # A packed hour: an uncompressed tar, memory-mapped, with its members'
+    # data offsets from the .idx file so a frame is one slice of the map.
+    # The tar stays readable by tar(1) and backup tools.
+
+    def __init__(self, path):
+        self.path = path
+        with open(f'{path}{INDEX_SUFFIX}') as f:
+            self.index = json.load(f)
+        self.stat = os.stat(path)
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if self.stat.st_size else b''
+
+    def names(self):
+        return sorted(self.index)
+
+    def size(self, name):
+        return self.index[name][1]
+
+    def read(self, name):
+        offset, size = self.index[name]
+        return self.map[offset:offset + size]
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+
+
+def pack_path(hourdir):
+    return hourdir.rstrip('/') + PACK_SUFFIX
+
+
+def open_pack(hourdir):
+    # The hour's pack, from a small per-process cache, or None
+    path = pack_path(hourdir)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    with _lock:
+        pack = _packs.get(path)
+        if pack is not None and (pack.stat.st_ino, pack.stat.st_mtime) \
+                == (st.st_ino, st.st_mtime):
+            _packs.move_to_end(path)
+            return pack
+        # Repacked since it was opened
+        if pack is not None:
+            pack.close()
+        pack = _packs[path] = HourPack(path)
+        while len(_packs) > OPEN_PACKS:
+            _packs.popitem(last=False)[1].close()
+        return pack
+
+
+def read_member(path):
+    # Bytes of a frame that has moved into its hour's pack
+    pack = open_pack(os.path.dirname(path))
+    name = os.path.basename(path)
+    if pack is None or name not in pack.index:
+        raise FileNotFoundError(f'No such frame: {path}')
+    return pack.read(name)
+
+
+def exists(path):
+    if os.path.exists(path):
+        return True
+    pack = open_pack(os.path.dirname(path))
+    return pack is not None and os.path.basename(path) in pack.index
+
+
+def getsize(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        pack = open_pack(os.path.dirname(path))
+        if pack is None or os.path.basename(path) not in pack.index:
+            raise
+        return pack.size(os.path.basename(path))
+
+
+def hour_exists(hourdir):
+    return os.path.isdir(hourdir) or os.path.exists(pack_path(hourdir))
+
+
+def list_hour(hourdir, suffix='.jpg'):
+    # Sorted names of an hour's frames, loose or packed
+    names = set()
+    try:
+        with os.scandir(hourdir) as it:
+            names.update(e.name for e in it if e.name.endswith(suffix)
+                         and not e.name.startswith('.'))
+    except FileNotFoundError:
+        pass
+    pack = open_pack(hourdir)
+    if pack is not None:
+        names.update(n for n in pack.index if n.endswith(suffix)
+                     and not n.startswith('.'))
+    return sorted(names)
+
+
+def list_tree(rootdir, suffix='.jpg'):
+    # Sorted paths of every frame below rootdir, loose or packed. Packed
+    # frames keep the path they had as loose files.
+    files = set(glob(f'{rootdir}/**/*{suffix}', recursive=True))
+    for tar in glob(f'{rootdir}/**/*{PACK_SUFFIX}', recursive=True):
+        hourdir = tar[:-len(PACK_SUFFIX)]
+        files.update(f'{hourdir}/{n}' for n in list_hour(hourdir, suffix))
+    return sorted(files)
+
+
+def pack_hour(hourdir):
+    # Roll an hour directory (and any existing pack for it) into one tar,
+    # then remove the loose files. Empty frames are dropped. Returns the
+    # number of members.
+    path = pack_path(hourdir)
+    tmp = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}')
+    old = open_pack(hourdir)
+    loose = {}
+    with os.scandir(hourdir) as it:
+        for e in it:
+            if e.is_file(follow_symlinks=False) \
+                    and not e.name.endswith('.tmp'):
+                loose[e.name] = e.stat()
+    members = set(loose) | set(old.index if old else ())
+    index = {}
+    newest = 0
+    with tarfile.open(tmp, 'w', format=tarfile.PAX_FORMAT) as tar:
+        for name in sorted(members):
+            if name in loose:
+                st = loose[name]
+                if st.st_size == 0:
+                    continue
+                with open(f'{hourdir}/{name}', 'rb') as f:
+                    data = f.read()
+                mtime = st.st_mtime
+            else:
+                data = old.read(name)
+                mtime = old.stat.st_mtime
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(mtime)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+            index[name] = [tar.offset - _padded(len(data)), len(data)]
+            newest = max(newest, mtime)
+    with open(f'{tmp}{INDEX_SUFFIX}', 'w') as f:
+        json.dump(index, f)
+    # Age policies read the pack's mtime, so it carries its newest frame's
+    if newest:
+        os.utime(tmp, (newest, newest))
+    os.replace(f'{tmp}{INDEX_SUFFIX}', f'{path}{INDEX_SUFFIX}')
+    os.replace(tmp, path)
+
+    # Readers fall back to the pack as soon as a loose file is gone
+    for name in loose:
+        os.remove(f'{hourdir}/{name}')
+    try:
+        os.rmdir(hourdir)
+    except OSError as e:
+        logger.info(f'Leaving {hourdir}: {e}')
+    return len(index)
+
+
+def _padded(size):
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def finished_hours(cam, min_age=MIN_AGE, now=None):
+    # Loose hour directories that ended at least min_age hours ago
+    now = now or datetime.now()
+    for tree in TREES:
+        for root in sorted(glob(tree.format(ARCHIVE, cam))):
+            for hourdir in sorted(glob(f'{root}/*/*/*/*/')):
+                hourdir = hourdir.rstrip('/')
+                try:
+                    start = datetime.strptime(
+                        '/'.join(hourdir.split('/')[-4:]), '%Y/%m/%d/%H')
+                except ValueError:
+                    continue
+                if start + timedelta(hours=1 + min_age) <= now:
+                    yield hourdir
+
+
+if __name__ == '__main__':
+    logger = my_utils.setup_logging("Pack Log")
+    if 'PYLOGLEVEL' in os.environ:
+        level = logging.getLevelName(os.getenv('PYLOGLEVEL', 'DEBUG'))
+        logger.setLevel(level)
+
+    args = parser.parse_args()
+    logger.info('Starting')
+    started = time.time()
+    hours = frames = 0
+    for hourdir in finished_hours(args.cam, args.min_age):
+        if args.dry_run:
+            logger.info(f'Would pack {hourdir}')
+        else:
+            n = pack_hour(hourdir)
+            logger.debug(f'Packed {n} frames from {hourdir}')
+            frames += n
+        hours += 1
+    logger.info(f'Packed {hours} hours, {frames} frames in '
+                f'{time.time() - started:.1f}s')
+    logger.info('Finished')
+    logging.shutdown()
@@ -3,46 +3,271 @@
 
 import argparse
 import logging
+import Metrics as my_metrics
 import os
+import time
 import Util as my_utils
 
-from datetime import datetime
+from ArchiveIndex import open_index
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from glob import glob
+from Pack import INDEX_SUFFIX, PACK_SUFFIX, exists
+
+CAMSDIR = os.getenv('CAMSDIR', '/data/cams')
+CONFDIR = '/app/camacquisition/etc'
+WORKERS = 16
+# Paths per unlink task when removing frames listed by an archive index
+BATCH = 1000
+DAY = 86400
+EPOCH = datetime(1970, 1, 1)
+
+# Where each artifact type lives under a camera's directory: path, number
+# of directory levels below it (YYYY/MM/DD/HH or YYYY/MM) and file suffix
+ARTIFACTS = {
+    'images': ('images/archive', 4, '.jpg'),
+    'derivatives': ('images/derivatives/*', 4, '.jpg'),
+    'composites': ('composites/archive', 2, '.jpg'),
+    'movies': ('movies', 0, '.avi'),
+    'gifs': ('images', 0, '.gif'),
+}
+
+# Policy per artifact type, overridden per camera by a "retention" block in
+# its config, e.g. {"retention": {"images": {"max_age": 365}}}.
+#   empty:   remove zero-byte files
+#   max_age: remove files last modified more than this many days ago
+#   days:    only sweep the dated directories of the last this many days
+#            (null, or --full, sweeps the whole tree)
+DEFAULT_RETENTION = {
+    'images': {'empty': True, 'days': 1},
+    'derivatives': {'empty': True, 'days': 1},
+    'composites': {'empty': True, 'days': 1},
+    'movies': {'max_age': 10},
+    'gifs': {},
+}
 
 logger = my_utils.setup_logging("PruneData Log")
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-c', '--cam', type=str, required=True, help='Camera code')
+parser.add_argument('-c', '--cam', type=str, action='append',
+                    help='Camera code; may be repeated (default: every '
+                         'camera in --confdir)')
+parser.add_argument('-d', '--confdir', type=str, default=CONFDIR,
+                    help=f'Camera config directory (default: {CONFDIR})')
+parser.add_argument('-n', '--dry-run', action='store_true',
+                    help='Report what would be removed without removing it')
+parser.add_argument('-j', '--workers', type=int, default=WORKERS,
+                    help=f'Threads for directory scans and unlinks '
+                         f'(default: {WORKERS})')
+parser.add_argument('--full', action='store_true',
+                    help='Sweep whole trees, ignoring each policy\'s "days"')
+
+
+def load_cameras(confdir, cams=None):
+    # Camera code -> config, the first config found for each camera
+    configs = {}
+    for configfile in sorted(glob(f'{confdir}/*.json')):
+        config = my_utils.read_json_config(configfile)
+        if 'cam' in config:
+            configs.setdefault(config['cam'], config)
+    if cams:
+        return {cam: configs.get(cam, {'cam': cam}) for cam in cams}
+    return configs
+
+
+def retention(config, kind):
+    policy = dict(DEFAULT_RETENTION[kind])
+    policy.update(config.get('retention', {}).get(kind, {}))
+    return policy
+
+
+def subdirs(path, levels, before=None):
+    # Directories exactly `levels` below path. With before, dated trees are
+    # cut to directories whose YYYY[/MM[/DD]] is no later than before's.
+    if levels == 0:
+        return [path] if os.path.isdir(path) else []
+    limit = before and [str(before.year), str(before.month).zfill(2),
+                        str(before.day).zfill(2)]
+
+    def walk(path, parts):
+        if len(parts) == levels:
+            return [path]
+        try:
+            with os.scandir(path) as it:
+                names = sorted(e.name for e in it
+                               if e.is_dir(follow_symlinks=False))
+        except FileNotFoundError:
+            return []
+        out = []
+        for name in names:
+            n = min(len(parts) + 1, 3)
+            if limit and (parts + [name])[:n] > limit[:n]:
+                continue
+            out.extend(walk(f'{path}/{name}', parts + [name]))
+        return out
+    return walk(path, [])
+
+
+def sweep_dirs(root, levels, days, now, before=None):
+    # Leaf directories to scan: those of the last `days` days (all of them
+    # if days is None) and, for an age limit, those dated on or before the
+    # cutoff day, the only ones that can hold files that old
+    if not days or not levels:
+        return subdirs(root, levels)
+    dated = min(levels, 3)
+    prefixes = []
+    for n in range(days):
+        t = now - timedelta(days=n)
+        parts = [str(t.year), str(t.month).zfill(2), str(t.day).zfill(2)]
+        prefix = '/'.join([root] + parts[:dated])
+        if prefix not in prefixes:
+            prefixes.append(prefix)
+    dirs = [d for p in prefixes for d in subdirs(p, levels - dated)]
+    if before:
+        seen = set(dirs)
+        dirs.extend(d for d in subdirs(root, levels, before)
+                    if d not in seen)
+    return dirs
+
+
+def scan_dir(path, suffix, policy, cutoff, dry_run, skip_ok=False):
+    # Files in one directory that the policy removes, as (path, size).
+    # Frames whose capture-time decode succeeded are never empty, so with
+    # skip_ok their stat is saved.
+    ok = set()
+    if skip_ok:
+        from Stats import load_stats
+        ok = {f for f, s in load_stats(glob(f'{path}/*{suffix}')).items()
+              if s['ok']}
+    out = []
+    with os.scandir(path) as it:
+        for entry in it:
+            name = entry.name
+            if not name.endswith(suffix) or name.startswith('.') \
+                    or entry.path in ok:
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if (policy.get('empty') and st.st_size == 0) \
+                    or (cutoff and st.st_mtime < cutoff):
+                out.append((entry.path, st.st_size))
+    if not dry_run:
+        out = unlink_all(out)
+    return out
+
+
+def unlink_all(files):
+    removed = []
+    for path, size in files:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        if path.endswith(PACK_SUFFIX):
+            try:
+                os.remove(f'{path}{INDEX_SUFFIX}')
+            except FileNotFoundError:
+                pass
+        removed.append((path, size))
+    return removed
+
+
+def index_candidates(index, policy, now):
+    # Image files past max_age, from the archive index rather than the disk.
+    # Frames are only indexed once written, so zero-byte files never show
+    # up here; those are still found by their size on disk.
+    if not policy.get('max_age'):
+        return []
+    cutoff = now - timedelta(days=policy['max_age'])
+    return [(p, None) for p in index.frames(EPOCH, cutoff)]
+
+
+@my_metrics.timed('prune')
+def prune(configs, workers=WORKERS, dry_run=False, full=False, now=None):
+    # Sweep every camera's artifacts on one thread pool. Returns
+    # {(cam, kind): [(path, size), ...]} of what was (or would be) removed.
+    now = now or datetime.now()
+    results = defaultdict(list)
+    indexes = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for cam, config in sorted(configs.items()):
+            camdir = f'{CAMSDIR}/{cam}'
+            for kind, (subpath, levels, suffix) in ARTIFACTS.items():
+                policy = retention(config, kind)
+                if not policy.get('empty') and not policy.get('max_age'):
+                    continue
+                days = None if full else policy.get('days')
+                cutoff = before = None
+                if policy.get('max_age'):
+                    cutoff = now.timestamp() - policy['max_age'] * DAY
+                    before = datetime.fromtimestamp(cutoff)
+                index = open_index(cam) if kind == 'images' else None
+                scan_policy, scan_cutoff = policy, cutoff
+                if index:
+                    # The index covers max_age; the disk scan only looks
+                    # for empty files
+                    scan_policy = {'empty': policy.get('empty')}
+                    scan_cutoff = None
+                    files = index_candidates(index, policy, now)
+                    indexes[cam] = (index, files)
+                    if dry_run:
+                        # Packed frames go with their pack, reported below
+                        results[(cam, kind)].extend(
+                            (p, n) for p, n in files if os.path.exists(p))
+                    else:
+                        for i in range(0, len(files), BATCH):
+                            f = pool.submit(unlink_all, files[i:i + BATCH])
+                            futures[f] = (cam, kind)
+                skip_ok = kind == 'images' and not scan_cutoff
+                for root in glob(f'{camdir}/{subpath}'):
+                    if scan_policy.get('empty') or scan_cutoff:
+                        for d in sweep_dirs(root, levels, days, now,
+                                            scan_cutoff and before):
+                            f = pool.submit(scan_dir, d, suffix, scan_policy,
+                                            scan_cutoff, dry_run, skip_ok)
+                            futures[f] = (cam, kind)
+                    if levels == 4 and cutoff:
+                        # Packed hours sit in their day directory
+                        for d in sweep_dirs(root, 3, days, now, before):
+                            f = pool.submit(scan_dir, d, PACK_SUFFIX, {},
+                                            cutoff, dry_run)
+                            futures[f] = (cam, kind)
+        for f in as_completed(futures):
+            try:
+                results[futures[f]].extend(f.result())
+            except OSError as e:
+                logger.error(f'Unable to prune {futures[f][0]}: {e}')
+
+    # Drop the rows of frames now gone, loose, with their pack or empty
+    for cam, (index, files) in indexes.items():
+        if not dry_run:
+            gone = [p for p, _ in files if not exists(p)]
+            gone += [p for p, n in results[(cam, 'images')] if n == 0]
+            index.remove(gone)
+        index.close()
+    return results
+
+
+def report(results, dry_run=False):
+    verb = 'Would remove' if dry_run else 'Removed'
+    for (cam, kind), files in sorted(results.items()):
+        for path, size in sorted(files):
+            logger.debug(f'{verb} {path}')
+        nbytes = sum(size or 0 for _, size in files)
+        if not dry_run:
+            my_metrics.count('pruned_files', len(files), cam=cam, kind=kind)
+            my_metrics.count('pruned_bytes', nbytes, cam=cam, kind=kind)
+        logger.info(f'{cam} {kind}: {verb.lower()} {len(files)} files, '
+                    f'{nbytes / 2 ** 20:.1f} MB')
 
 
 def prune_data(cam):
-    now = datetime.now()
-    year = str(now.year)
-    month = str(now.month).zfill(2)
-    day = str(now.day).zfill(2)
-    ten_days_ago = now.timestamp() - 10 * 86400
-    camdir = f'/data/cams/{cam}'
-    idir = f'{camdir}/images/archive/{year}/{month}/{day}'
-    cdir = f'{camdir}/composites/archive/{year}/{month}'
-    mdir = f'{camdir}/movies'
-
-    # Delete empty images files from hours folders
-    for filename in glob(f'{idir}/*/*.jpg', recursive=True):
-        if os.stat(filename).st_size == 0:
-            logger.info(f'Removing empty file: {filename}')
-            os.remove(filename)
-
-    # Delete empty composites from month
-    for filename in glob(f'{cdir}/*.jpg'):
-        if os.stat(filename).st_size == 0:
-            logger.info(f'Removing empty composite: {filename}')
-            os.remove(filename)
-
-    # Delete movies > 10 days old
-    for filename in glob(f'{mdir}/*.avi'):
-        if os.stat(filename).st_mtime < ten_days_ago:
-            logger.info(f'Removing old video: {filename}')
-            os.remove(filename)
+    # Default policies for a single camera
+    report(prune({cam: {'cam': cam}}))
 
 
 if __name__ == '__main__':
@@ -52,6 +277,14 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
     logger.info('Starting')
-    prune_data(args.cam)
+    configs = load_cameras(args.confdir, args.cam)
+    my_metrics.setup_metrics('prunedata')
+    if not configs:
+        logger.error(f'No camera configs found in {args.confdir}')
+    started = time.time()
+    results = prune(configs, args.workers, args.dry_run, args.full)
+    report(results, args.dry_run)
+    logger.info(f'Swept {len(configs)} cameras in '
+                f'{time.time() - started:.1f}s')
     logger.info('Finished')
     logging.shutdown()
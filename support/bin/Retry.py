@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import random
+import time
+
+from datetime import datetime, timedelta
+
+# Defaults, overridable per camera with a "retry" block in the config
+ATTEMPTS = 10
+BACKOFF = 1
+MAX_BACKOFF = 10
+DEADLINE = 55
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 600
+
+
+class RetryPolicy(object):
+    # Bounded retries with exponential backoff and jitter, all inside a
+    # deadline measured from the start of the capture slot
+
+    def __init__(self, attempts=ATTEMPTS, backoff=BACKOFF,
+                 max_backoff=MAX_BACKOFF, deadline=DEADLINE, jitter=True,
+                 logger=None):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.jitter = jitter
+        self.logger = logger or logging.getLogger(__name__)
+
+    @classmethod
+    def from_config(cls, config, logger=None):
+        retry = config.get('retry', {})
+        return cls(attempts=retry.get('attempts', ATTEMPTS),
+                   backoff=retry.get('backoff', BACKOFF),
+                   max_backoff=retry.get('max_backoff', MAX_BACKOFF),
+                   deadline=retry.get('deadline', DEADLINE),
+                   jitter=retry.get('jitter', True),
+                   logger=logger)
+
+    def delay(self, attempt):
+        # Equal jitter: half the exponential step, plus up to half again
+        step = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if not self.jitter:
+            return step
+        return step / 2 + random.uniform(0, step / 2)
+
+    def remaining(self, start):
+        end = start + timedelta(seconds=self.deadline)
+        return (end - datetime.now()).total_seconds()
+
+    def report(self, name, attempt, began, error=None):
+        latency = time.time() - began
+        if error is None:
+            self.logger.info(f'{name}: attempt {attempt} ok '
+                             f'in {latency:.2f}s')
+        else:
+            self.logger.info(f'{name}: attempt {attempt} failed '
+                             f'in {latency:.2f}s: {error!r}')
+
+    def call(self, fn, start, timeout, name=''):
+        # Call fn(timeout) until it succeeds; None once out of attempts
+        # or time. Each attempt's timeout is clipped to the deadline.
+        for attempt in range(1, self.attempts + 1):
+            remaining = self.remaining(start)
+            if remaining <= 0:
+                break
+            began = time.time()
+            try:
+                result = fn(min(timeout, remaining))
+            except Exception as e:
+                self.report(name, attempt, began, e)
+            else:
+                self.report(name, attempt, began)
+                return result
+            if attempt < self.attempts:
+                time.sleep(max(0, min(self.delay(attempt),
+                                      self.remaining(start))))
+        self.logger.info(f'{name}: giving up.')
+        return None
+
+    async def call_async(self, fn, start, timeout, name=''):
+        # As call(), for an fn(timeout) that returns an awaitable
+        import asyncio
+        for attempt in range(1, self.attempts + 1):
+            remaining = self.remaining(start)
+            if remaining <= 0:
+                break
+            began = time.time()
+            try:
+                result = await fn(min(timeout, remaining))
+            except Exception as e:
+                self.report(name, attempt, began, e)
+            else:
+                self.report(name, attempt, began)
+                return result
+            if attempt < self.attempts:
+                await asyncio.sleep(max(0, min(self.delay(attempt),
+                                               self.remaining(start))))
+        self.logger.info(f'{name}: giving up.')
+        return None
+
+
+class CircuitBreaker(object):
+    # Skips a camera after `threshold` failed captures in a row until
+    # `cooldown` seconds have passed, then lets one trial capture through.
+    # With a state file the count survives between cron runs.
+
+    def __init__(self, threshold=BREAKER_THRESHOLD,
+                 cooldown=BREAKER_COOLDOWN, state_file=None):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state_file = state_file
+        self.failures = 0
+        self.opened = 0
+        if state_file and os.path.exists(state_file):
+            try:
+                with open(state_file) as f:
+                    state = json.load(f)
+                self.failures = state['failures']
+                self.opened = state['opened']
+            except (ValueError, KeyError):
+                pass
+
+    @classmethod
+    def from_config(cls, config, state_file=None):
+        retry = config.get('retry', {})
+        return cls(threshold=retry.get('breaker_threshold',
+                                       BREAKER_THRESHOLD),
+                   cooldown=retry.get('breaker_cooldown', BREAKER_COOLDOWN),
+                   state_file=state_file)
+
+    @property
+    def is_open(self):
+        return self.failures >= self.threshold
+
+    def allow(self):
+        return not self.is_open or time.time() >= self.opened + self.cooldown
+
+    def retry_at(self):
+        return datetime.fromtimestamp(self.opened + self.cooldown)
+
+    def record(self, ok):
+        if ok:
+            self.failures = 0
+            self.opened = 0
+        else:
+            self.failures += 1
+            if self.is_open:
+                self.opened = time.time()
+        self.save()
+
+    def save(self):
+        if not self.state_file:
+            return
+        tmpfile = f'{self.state_file}.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump({'failures': self.failures, 'opened': self.opened}, f)
+        os.replace(tmpfile, self.state_file)
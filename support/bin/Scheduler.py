@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import Metrics as my_metrics
+import os
+import threading
+import time
+import Util as my_utils
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from glob import glob
+
+CONFDIR = '/app/camacquisition/etc'
+BREAKER = '/tmp/breaker{0}.json'
+# Lower runs first. Batch jobs never take the slots kept for acquisition,
+# so a capture starts on the tick even while movies and GIFs are running.
+PRIORITIES = {'acquire': 0, 'prune': 1, 'composite': 2, 'gif': 3,
+              'movie': 4}
+# Every camera with a "url" acquires on its "interval" and prunes once a
+# day. Other jobs run for cameras that list them in a "jobs" block, which
+# can also override these, e.g.
+#   {"jobs": {"composite": {"at": "05:10"}, "gif": {"every": 3600},
+#             "movie": {"at": "00:10"}}}
+DEFAULT_JOBS = {'prune': {'at': '00:30'}}
+# Seconds between metrics summaries
+METRICS_INTERVAL = 300
+
+logger = my_utils.setup_logging("Scheduler Log")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--confdir', type=str, default=CONFDIR,
+                    help=f'Camera config directory (default: {CONFDIR})')
+parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                    help='Worker processes shared by every job (default: '
+                         'CPU count)')
+parser.add_argument('-r', '--reserve', type=int, required=False,
+                    help='Workers kept free of batch jobs for acquisition '
+                         '(default: half of them)')
+parser.add_argument('-m', '--metrics', type=str, required=False,
+                    help='Also write the metrics summary to this JSON file')
+
+
+# Job bodies. They run in the worker processes, which import the scripts
+# once and keep per-camera state between runs.
+
+_sessions = {}
+
+
+def warm_up():
+    # Pay for numpy/cv2/PIL once per worker rather than once per job. The
+    # scripts defer them to the code that uses them, so load them here.
+    my_metrics.setup_metrics('scheduler', f'worker{os.getpid()}')
+    import cv2  # noqa: F401
+    import requests  # noqa: F401
+    import CamAcq
+    CamAcq.import_pipeline()
+    import DailyComposite  # noqa: F401
+    import DailyMovie  # noqa: F401
+    import MakeGif  # noqa: F401
+    import PruneData  # noqa: F401
+
+
+def acquire(config, start):
+    import CamAcq
+    from Retry import CircuitBreaker, RetryPolicy
+    cam = config['cam']
+    if cam not in _sessions:
+        _sessions[cam] = (CamAcq.make_session(config),
+                          RetryPolicy.from_config(config, CamAcq.logger))
+    session, policy = _sessions[cam]
+    # Workers share the camera's breaker through its state file
+    breaker = CircuitBreaker.from_config(config, BREAKER.format(cam))
+    return CamAcq.capture(config, session, start, policy, breaker)
+
+
+def composite(config, start):
+    import DailyComposite
+    msg = DailyComposite.create_composite(
+        config['cam'], config['name'], config['size'], True,
+        incremental=bool(config.get('incremental_composite')))
+    # create_composite reports failure by returning a message
+    if msg:
+        raise RuntimeError(msg)
+
+
+def movie(config, start):
+    import DailyMovie
+    DailyMovie.config = config
+    return DailyMovie.cam_video('yesterday')
+
+
+def gif(config, start):
+    import MakeGif
+    MakeGif.config = config
+    frames = MakeGif.gather_images()
+    if frames:
+        MakeGif.create_gif(frames)
+
+
+def prune(config, start):
+    import PruneData
+    PruneData.report(PruneData.prune({config['cam']: config}))
+
+
+JOBS = {'acquire': acquire, 'composite': composite, 'movie': movie,
+        'gif': gif, 'prune': prune}
+
+
+def run_job(kind, config, start):
+    try:
+        return JOBS[kind](config, start)
+    finally:
+        my_metrics.maybe_flush()
+
+
+class Job(object):
+    # One scheduled job for one camera: runs every `every` seconds, on
+    # whole multiples of it, or daily `at` HH:MM
+
+    def __init__(self, kind, config, every=None, at=None):
+        self.kind = kind
+        self.config = config
+        self.cam = config['cam']
+        self.every = every
+        self.at = at
+        self.priority = PRIORITIES[kind]
+        self.pending = False
+
+    @property
+    def name(self):
+        return f'{self.kind}:{self.cam}'
+
+    def due(self, tick):
+        if self.every:
+            return int(tick.timestamp()) % self.every == 0
+        return tick.second == 0 and tick.strftime('%H:%M') == self.at
+
+
+def load_jobs(confdir):
+    jobs = []
+    for configfile in sorted(glob(f'{confdir}/*.json')):
+        config = my_utils.read_json_config(configfile)
+        if 'cam' not in config:
+            continue
+        if 'url' in config:
+            jobs.append(Job('acquire', config,
+                            every=config.get('interval', 60)))
+        specs = dict(DEFAULT_JOBS)
+        specs.update(config.get('jobs', {}))
+        for kind, spec in sorted(specs.items()):
+            if kind not in JOBS or kind == 'acquire' or spec is None:
+                continue
+            jobs.append(Job(kind, config, spec.get('every'), spec.get('at')))
+    return jobs
+
+
+def job_totals(snapshot):
+    # Running totals per job kind from a metrics snapshot: runs, failures,
+    # skips, and the count, sum and buckets of the wait and run histograms
+    totals = defaultdict(lambda: defaultdict(int))
+    for c in snapshot['counters'] if snapshot else ():
+        if c['name'] in ('cams_job_failures', 'cams_jobs_skipped'):
+            key = 'failures' if c['name'] == 'cams_job_failures' \
+                else 'skipped'
+            totals[c['kind']][key] += c['value']
+    for h in snapshot['histograms'] if snapshot else ():
+        if h['name'] in ('cams_job_wait_seconds', 'cams_job_run_seconds'):
+            what = 'wait' if h['name'] == 'cams_job_wait_seconds' else 'run'
+            totals[h['kind']][f'{what}_count'] = h['count']
+            totals[h['kind']][f'{what}_sum'] = h['sum']
+            totals[h['kind']][f'{what}_buckets'] = h['buckets']
+    return totals
+
+
+def slowest(buckets, count, le):
+    # Upper bound of the highest histogram bucket used, None past the last
+    if count > sum(buckets):
+        return None
+    used = [bound for bound, n in zip(le, buckets) if n]
+    return used[-1] if used else 0
+
+
+class Scheduler(object):
+    # Priority queue in front of one process pool. Batch jobs may only
+    # fill workers - reserve slots; a job still queued or running when it
+    # comes due again is skipped rather than stacked.
+
+    def __init__(self, workers, reserve=None):
+        self.workers = workers
+        if reserve is None:
+            reserve = workers // 2
+        self.batch_slots = max(1, workers - reserve)
+        self.pool = self._make_pool()
+        self.queue = []
+        self.seq = itertools.count()
+        self.running = 0
+        self.batch_running = 0
+        self.lock = threading.Lock()
+        self.max_depth = 0
+        # Metric totals at the last summary
+        self.totals = {}
+
+    def submit(self, job, tick):
+        with self.lock:
+            if job.pending:
+                my_metrics.count('jobs_skipped', kind=job.kind)
+                logger.info(f'{job.name} still pending, skipping {tick}')
+                return
+            job.pending = True
+            heapq.heappush(self.queue, (job.priority, next(self.seq), job,
+                                        tick, time.time()))
+            self.max_depth = max(self.max_depth, len(self.queue))
+            my_metrics.gauge('queue_depth', len(self.queue))
+            started = self._dispatch()
+        self._watch(started)
+
+    def _make_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   initializer=warm_up)
+
+    def _dispatch(self):
+        # Start queued jobs while slots allow; called with the lock held.
+        # Returns the started jobs for the caller to _watch once it has
+        # released the lock: a job that has already finished runs its
+        # callback straight away, and that takes the lock.
+        started_jobs = []
+        while self.queue and self.running < self.workers:
+            job = self.queue[0][2]
+            if job.kind != 'acquire' \
+                    and self.batch_running >= self.batch_slots:
+                # Only acquisition may use the reserved slots; it always
+                # sorts ahead of batch work, so nothing else can start
+                break
+            _, _, job, tick, queued = heapq.heappop(self.queue)
+            self.running += 1
+            if job.kind != 'acquire':
+                self.batch_running += 1
+            started = time.time()
+            future = self._submit(job, tick)
+            started_jobs.append((future, job, queued, started))
+        return started_jobs
+
+    def _submit(self, job, tick):
+        try:
+            return self.pool.submit(run_job, job.kind, job.config, tick)
+        except BrokenProcessPool:
+            # A worker died. Jobs that were on the old pool fail with it;
+            # everything from now on goes to a new one.
+            logger.error('Worker pool broken, starting a new one')
+            my_metrics.count('pool_restarts')
+            self.pool.shutdown(wait=False)
+            self.pool = self._make_pool()
+            return self.pool.submit(run_job, job.kind, job.config, tick)
+
+    def _watch(self, started_jobs):
+        for future, job, queued, started in started_jobs:
+            future.add_done_callback(
+                lambda f, job=job, queued=queued, started=started:
+                self._done(f, job, queued, started))
+
+    def _done(self, future, job, queued, started):
+        run = time.time() - started
+        ok = future.exception() is None
+        if not ok:
+            logger.error(f'{job.name} failed: {future.exception()}')
+        logger.debug(f'{job.name} waited {started - queued:.2f}s, '
+                     f'ran {run:.2f}s')
+        my_metrics.observe('job_wait_seconds', started - queued,
+                           kind=job.kind)
+        my_metrics.observe('job_run_seconds', run, kind=job.kind)
+        if not ok:
+            my_metrics.count('job_failures', kind=job.kind)
+        with self.lock:
+            job.pending = False
+            self.running -= 1
+            if job.kind != 'acquire':
+                self.batch_running -= 1
+            started_jobs = self._dispatch()
+        self._watch(started_jobs)
+
+    def summary(self):
+        # Jobs since the last summary, from the differences in the metrics'
+        # running totals. Maxima are histogram bucket bounds.
+        with self.lock:
+            depth, running = len(self.queue), self.running
+            max_depth, self.max_depth = self.max_depth, depth
+        snapshot = my_metrics.snapshot()
+        le = snapshot['le'] if snapshot else []
+        totals = job_totals(snapshot)
+        out = {'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+               'queue_depth': depth, 'max_queue_depth': max_depth,
+               'running': running, 'jobs': {}}
+        for kind in sorted(totals):
+            now, before = totals[kind], self.totals.get(kind, {})
+            delta = {k: now[k] - before.get(k, 0)
+                     for k in ('failures', 'skipped', 'wait_count',
+                               'wait_sum', 'run_count', 'run_sum')}
+            if not any(delta.values()):
+                continue
+            runs = delta['run_count']
+            m = {'runs': runs, 'failures': delta['failures'],
+                 'skipped': delta['skipped']}
+            for what in ('wait', 'run'):
+                buckets = [n - b for n, b in zip(
+                    now[f'{what}_buckets'] or [0] * len(le),
+                    before.get(f'{what}_buckets') or [0] * len(le))]
+                m[f'{what}_mean'] = delta[f'{what}_sum'] / runs if runs else 0
+                m[f'{what}_max'] = slowest(buckets, runs, le)
+            out['jobs'][kind] = m
+        self.totals = {kind: dict(t) for kind, t in totals.items()}
+        return out
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+def bound(seconds):
+    # A summary maximum, which is a histogram bucket bound
+    if seconds is None:
+        return f'>{my_metrics.BUCKETS[-2]}s'
+    return f'<={seconds}s'
+
+
+def log_summary(summary, path=None):
+    logger.info(f"Queue depth {summary['queue_depth']} "
+                f"(max {summary['max_queue_depth']}), "
+                f"{summary['running']} running")
+    for kind, m in summary['jobs'].items():
+        logger.info(f"{kind}: {m['runs']} runs, {m['failures']} failed, "
+                    f"{m['skipped']} skipped, wait {m['wait_mean']:.2f}s "
+                    f"(max {bound(m['wait_max'])}), "
+                    f"run {m['run_mean']:.2f}s (max {bound(m['run_max'])})")
+    if path:
+        my_utils.write_atomic(path, json.dumps(summary).encode())
+
+
+def run(confdir, workers, reserve=None, metrics=None):
+    jobs = load_jobs(confdir)
+    if not jobs:
+        logger.error(f'No camera configs found in {confdir}')
+        return
+    logger.info(f'Scheduling {len(jobs)} jobs on {workers} workers')
+    scheduler = Scheduler(workers, reserve)
+    last_summary = time.time()
+    try:
+        while True:
+            # Sleep to the next whole second, then queue every job due on it
+            time.sleep(1 - (time.time() % 1))
+            tick = datetime.now().replace(microsecond=0)
+            for job in jobs:
+                if job.due(tick):
+                    scheduler.submit(job, tick)
+            my_metrics.maybe_flush()
+            if time.time() - last_summary >= METRICS_INTERVAL:
+                log_summary(scheduler.summary(), metrics)
+                last_summary = time.time()
+    except KeyboardInterrupt:
+        logger.info('Stopping')
+    finally:
+        scheduler.shutdown()
+
+
+if __name__ == '__main__':
+    if 'PYLOGLEVEL' in os.environ:
+        level = logging.getLevelName(os.getenv('PYLOGLEVEL', 'DEBUG'))
+        logger.setLevel(level)
+
+    args = parser.parse_args()
+    logger.info('Starting')
+    # Kept in memory without CAMMETRICS too, for the summaries
+    my_metrics.setup_metrics('scheduler', in_memory=True)
+    run(args.confdir, args.workers, args.reserve, args.metrics)
+    logger.info('Finished')
+    logging.shutdown()
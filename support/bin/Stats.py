@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import fcntl
+import numpy as np
+import os
+
+from Frames import decode_frame
+from Pack import read_member
+
+# Per-hour sidecar next to the archived frames. Each frame appends one
+# fixed-width record, so an hour reads back with np.fromfile and every
+# statistic is a column (stats['max'], stats['band'], ...).
+SIDECAR = '.stats'
+# Downsampled luma preview, width x height
+PREVIEW = (32, 18)
+# Luma at or above which a pixel counts as saturated
+SATURATED = 250
+# Longest frame name a record holds, in bytes
+NAME_BYTES = 48
+STATS_DTYPE = np.dtype([
+    ('name', f'S{NAME_BYTES}'),
+    ('ok', 'u1'),
+    ('mean', '<f4'),
+    ('max', '<f4'),
+    ('saturated', '<u4'),
+    ('band', '<u4'),
+    ('preview', 'u1', (PREVIEW[1], PREVIEW[0])),
+])
+
+
+def sidecar_path(path):
+    # Sidecar for the hour directory holding the frame at path
+    return os.path.join(os.path.dirname(path), SIDECAR)
+
+
+def frame_stats(name, frame):
+    # Statistics of a decoded BGR frame, or of an unreadable one (None).
+    # Luma is computed exactly as the composite computes it. cv2 is only
+    # needed here, at capture time; the readers need just numpy.
+    import cv2
+    from Composite import BAD_HI, BAD_LO, compute_luma
+    encoded = name.encode()
+    if len(encoded) > NAME_BYTES:
+        # numpy would silently cut it short, and it would never match
+        raise ValueError(f'Frame name {name} is longer than {NAME_BYTES} '
+                         f'bytes')
+    stats = np.zeros((), dtype=STATS_DTYPE)
+    stats['name'] = encoded
+    if frame is None:
+        return stats
+    luma = compute_luma(frame)
+    stats['ok'] = 1
+    stats['mean'] = luma.mean()
+    stats['max'] = luma.max()
+    stats['saturated'] = np.count_nonzero(luma >= SATURATED)
+    stats['band'] = np.count_nonzero(np.logical_and(luma > BAD_LO,
+                                                    luma < BAD_HI))
+    stats['preview'] = np.rint(cv2.resize(luma, PREVIEW,
+                                          interpolation=cv2.INTER_AREA))
+    return stats
+
+
+def record_stats(path, data):
+    # Decode an archived frame's bytes and append its record to the hour's
+    # sidecar
+    try:
+        frame = decode_frame(data)
+    except ValueError:
+        frame = None
+    return record_frame(path, frame)
+
+
+def record_frame(path, frame):
+    # Append the record of an archived frame that is already decoded
+    stats = frame_stats(os.path.basename(path), frame)
+    append_stats(sidecar_path(path), stats)
+    return stats
+
+
+def image_frame(im):
+    # A PIL image as the BGR array cv2 would decode it to, so its luma
+    # weights line up with the composite's
+    return np.asarray(im.convert('RGB'))[:, :, ::-1]
+
+
+def append_stats(path, stats):
+    # Records are fixed width with nothing to resync on, so a write torn
+    # by a crash would misalign every record after it. Cut the file back
+    # to whole records before appending, under a lock so two writers
+    # can't cut each other's records.
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        size = os.fstat(fd).st_size
+        if size % STATS_DTYPE.itemsize:
+            os.ftruncate(fd, size - size % STATS_DTYPE.itemsize)
+        os.write(fd, stats.tobytes())
+    finally:
+        os.close(fd)
+
+
+def read_stats(hourdir):
+    # All records for an hour directory; empty if it has no sidecar
+    path = os.path.join(hourdir, SIDECAR)
+    if not os.path.exists(path):
+        try:
+            data = read_member(path)
+        except FileNotFoundError:
+            return np.zeros(0, dtype=STATS_DTYPE)
+        count = len(data) // STATS_DTYPE.itemsize
+        return np.frombuffer(data, dtype=STATS_DTYPE, count=count)
+    # Ignore a trailing partial record from an interrupted write; the
+    # next append cuts it off
+    count = os.path.getsize(path) // STATS_DTYPE.itemsize
+    return np.fromfile(path, dtype=STATS_DTYPE, count=count)
+
+
+def load_stats(files):
+    # Records for the given frame files, keyed by path. Frames recorded
+    # more than once keep their latest record; frames without one are
+    # left out.
+    out = {}
+    for hourdir in sorted({os.path.dirname(f) for f in files}):
+        for stats in read_stats(hourdir):
+            out[os.path.join(hourdir, stats['name'].decode())] = stats
+    return {f: out[f] for f in files if f in out}
+
+
+def drop_unreadable(files, stats=None):
+    # Frames whose capture-time decode failed, dropped without opening them
+    stats = load_stats(files) if stats is None else stats
+    return [f for f in files if f not in stats or stats[f]['ok']]
@@ -2,6 +2,7 @@
 
 import json
 import logging
+import os
 
 
 def read_json_config(config_file):
@@ -10,6 +11,28 @@ def read_json_config(config_file):
         return json.load(f)
 
 
+def write_atomic(path, data):
+    # Write next to the destination and rename over it, so readers never
+    # see a partial file
+    tmpfile = f'{os.path.dirname(path)}/.{os.path.basename(path)}.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(data)
+    os.replace(tmpfile, path)
+
+
+def link_atomic(src, path):
+    # Atomically point path at src's data, copying if a link isn't possible
+    tmpfile = f'{os.path.dirname(path)}/.{os.path.basename(path)}.tmp'
+    if os.path.lexists(tmpfile):
+        os.remove(tmpfile)
+    try:
+        os.link(src, tmpfile)
+    except OSError:
+        with open(src, 'rb') as f:
+            return write_atomic(path, f.read())
+    os.replace(tmpfile, path)
+
+
 def setup_logging(name="Error logs"):
     global logger
     logger = logging.getLogger(name)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import threading
+
+from PIL import Image
+
+POSITIONS = ('bottom-left', 'bottom-right', 'top-left', 'top-right')
+
+_cache = {}
+_lock = threading.Lock()
+
+
+class Watermark(object):
+    # A watermark PNG decoded once and kept as premultiplied color plus
+    # inverse alpha, per rendered size, so stamping a frame is one blend
+    # over the corner it covers
+
+    def __init__(self, path):
+        with Image.open(path) as wm:
+            self.source = wm.convert('RGBA')
+        self.size = self.source.size
+        self._layers = {}
+
+    def layer(self, scale=1.0):
+        w, h = self.size
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        if size not in self._layers:
+            src = self.source
+            if size != self.size:
+                src = src.resize(size, Image.LANCZOS)
+            rgba = np.asarray(src, dtype=np.float32)
+            alpha = rgba[:, :, 3:] / 255
+            self._layers[size] = (rgba[:, :, :3] * alpha, 1 - alpha, src)
+        return self._layers[size]
+
+    def box(self, im_size, wm_size, position='bottom-left', margin=10):
+        w, h = im_size
+        w2, h2 = wm_size
+        if position not in POSITIONS:
+            raise ValueError(f'Unknown watermark position: {position}')
+        x = margin if position.endswith('left') else w - (w2 + margin)
+        y = margin if position.startswith('top') else h - (h2 + margin)
+        return (x, y, x + w2, y + h2)
+
+    def apply(self, im, position='bottom-left', margin=10, scale=1.0):
+        # Stamp the watermark onto a PIL image in place
+        premult, inverse, src = self.layer(scale)
+        box = self.box(im.size, src.size, position, margin)
+        if im.mode != 'RGB' or box[0] < 0 or box[1] < 0 \
+                or box[2] > im.size[0] or box[3] > im.size[1]:
+            im.paste(src, box[:2], src)
+            return im
+        region = np.asarray(im.crop(box), dtype=np.float32)
+        region *= inverse
+        region += premult
+        np.rint(region, out=region)
+        im.paste(Image.fromarray(region.astype(np.uint8), 'RGB'), box[:2])
+        return im
+
+
+def get_watermark(path):
+    # One decoded watermark per path for the life of the process
+    with _lock:
+        if path not in _cache:
+            _cache[path] = Watermark(path)
+        return _cache[path]
+
+
+def apply_watermark(im, path, options=None):
+    # options is a camera's "watermark" config block: position, margin,
+    # scale
+    options = options or {}
+    return get_watermark(path).apply(im,
+                                     options.get('position', 'bottom-left'),
+                                     options.get('margin', 10),
+                                     options.get('scale', 1.0))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+from Composite import reject_bad_pixels  # noqa: E402
+
+
+def old_reject_bad_pixels(A2):
+    # The loop from DailyComposite.create_composite before it was
+    # vectorized, unchanged but for returning the count. It zeroes A2 in
+    # place as it scans.
+    rejected = 0
+    for r in range(A2.shape[0]):
+        for c in range(A2.shape[1]):
+            if np.logical_and(A2[r, c] > 127,
+                              A2[r, c] < 129):
+                rmin = r - 5
+                if rmin < 0:
+                    rmin = 0
+                rmax = r + 5
+                if rmax >= A2.shape[0]:
+                    rmax = A2.shape[0] - 1
+                cmin = c - 5
+                if cmin < 0:
+                    cmin = 0
+                cmax = c + 5
+                if cmax >= A2.shape[1]:
+                    rmax = A2.shape[1] - 1
+                Acut = A2[rmin:rmax, cmin:cmax]
+                Atest2 = np.logical_and(Acut > 127,
+                                        Acut < 129)
+                badsum2 = sum(sum(Atest2))
+                if badsum2 > 10:
+                    A2[r, c] = 0
+                    rejected += 1
+    return rejected
+
+
+def synthetic_luma(shape, density, rng):
+    # Luma with the bad pixel signature in small clumps at roughly the
+    # given density, the rest kept out of the band
+    luma = rng.uniform(0, 255, shape)
+    luma[(luma > 126) & (luma < 130)] = 0
+    seeds = rng.random_sample(shape) < density / 3
+    band = seeds | np.roll(seeds, 1, axis=1) | np.roll(seeds, 1, axis=0)
+    luma[band] = 128
+    return luma
+
+
+class RejectBadPixelsTest(unittest.TestCase):
+
+    def check(self, shape, density, seed):
+        luma = synthetic_luma(shape, density, np.random.RandomState(seed))
+        expected = luma.copy()
+        expected_count = old_reject_bad_pixels(expected)
+        count = reject_bad_pixels(luma)
+        differ = np.count_nonzero(luma != expected)
+        self.assertEqual(differ, 0, f'{shape} at density {density}, seed '
+                                    f'{seed}: {differ} pixels differ')
+        self.assertEqual(count, expected_count)
+
+    def test_matches_old_loop(self):
+        for density in (0.02, 0.05, 0.1, 0.3, 0.6):
+            for seed in range(3):
+                self.check((60, 80), density, seed)
+
+    def test_matches_old_loop_small(self):
+        # Frames a little taller than wide, where the right edge typo's
+        # rmax of w - 1 cuts rows off inside the frame, and frames hardly
+        # bigger than a window. (Much taller frames made the old loop sum
+        # an empty window and fail.)
+        for shape in ((34, 32), (36, 33), (12, 12), (7, 9)):
+            for seed in range(3):
+                self.check(shape, 0.3, seed)
+
+    def test_band_given(self):
+        luma = synthetic_luma((60, 80), 0.3, np.random.RandomState(0))
+        expected = luma.copy()
+        old_reject_bad_pixels(expected)
+        band = np.logical_and(luma > 127, luma < 129)
+        reject_bad_pixels(luma, band)
+        self.assertTrue((luma == expected).all())
+
+
+if __name__ == '__main__':
+    unittest.main()